@@ -15,13 +15,21 @@ to the bag's contents.
 import zc.zk
 import zookeeper
 import sys
+import collections
+import threading
 import traceback
 import pettingzoo.utils
-from pettingzoo.deleted import Deleted
+from pettingzoo.deleted import Deleted, watch_many
 from pettingzoo.utils import get_logger
 
 ITEM_PATH = "/item"
 TOKEN_PATH = "/token"
+TRACK_EXISTS = "exists"
+TRACK_CHILDREN = "children"
+CHANGE_LOG_SIZE = 1024
+# Most stale tokens a bag deletes per token event; the deletes fire the token
+# watch again, so the rest are swept on the following events
+TOKEN_SWEEP_BATCH = 100
 
 class DistributedBag(object):
 	"""
@@ -34,6 +42,18 @@ class DistributedBag(object):
 
 	:param connection: a zc.zk.ZooKeeper connection
 	:param path: zookeeper path of the distributed bag
+	:param tracking: (Default TRACK_EXISTS) how the bag notices changes. \
+	  TRACK_EXISTS watches the token path for additions and sets one exists \
+	  watch per item for removals.  TRACK_CHILDREN sets a single children \
+	  watch on the item path and diffs the ids on every change, which keeps \
+	  one watch no matter how many items are in the bag, at the cost of \
+	  listing every item on each change.  Bags using either mode can share \
+	  the same path.
+	:param prefetch: (Default False) if true, the payload of every item \
+	  added to the bag is read in the background as soon as the add is \
+	  seen, so get and get_many are served from the payload cache.
+	:param dispatcher: (Optional) the pettingzoo.utils.Dispatcher that runs \
+	  this bag's callbacks.  Defaults to pettingzoo.utils.get_dispatcher().
 
 	**Note**
 
@@ -43,45 +63,89 @@ class DistributedBag(object):
 	Callbacks should be in the form of some_callback(dbag, id) where dbag is
 	the instance of this class, and id is the bag id of the element that has
 	been added or removed.
+
+	Batch listeners are an alternative to these callbacks.  They are called
+	once per change seen by the bag with every id that was added and removed.
+	See add_batch_listener.
+
+	All callbacks are run by the dispatcher, outside of the bag's lock and off
+	the zookeeper event thread, one at a time and in the order of the changes.
+
+	The ids in the bag are published as an immutable frozenset that is
+	replaced on every change, together with a version that counts the
+	changes.  get_items returns it without locking or copying.
+	get_items_since returns only what changed after a given version.
 	"""
-	def __init__(self, connection, path):
+	def __init__(self, connection, path, tracking=TRACK_EXISTS, prefetch=False,
+			dispatcher=None):
+		if tracking not in (TRACK_EXISTS, TRACK_CHILDREN):
+			raise Exception("Unknown DistributedBag tracking: %s" % tracking)
 		self.connection = connection
 		self.path = path
+		self.tracking = tracking
+		self.prefetch = prefetch
+		self.dispatcher = dispatcher or pettingzoo.utils.get_dispatcher()
 		self.connection.create_recursive(
 			path + ITEM_PATH, "", acl=zc.zk.OPEN_ACL_UNSAFE)
 		self.connection.create_recursive(
 			path + TOKEN_PATH, "", acl=zc.zk.OPEN_ACL_UNSAFE)
-		self.lock = pettingzoo.utils.ReadWriteLock()
+		self.lock = pettingzoo.utils.FairReadWriteLock()
 		self.ids = set()
+		# Bumped on every change.  snapshot is (version, frozenset of ids),
+		# built by the first read after a change and swapped as a whole, so
+		# a bulk load does not copy the ids once per event.
+		self.version = 0
+		self.snapshot = (0, frozenset())
+		self.changes = collections.deque(maxlen=CHANGE_LOG_SIZE)
 		self.add_callbacks = []
 		self.delete_callbacks = []
+		self.batch_listeners = []
 		self.deletion_handlers = {}
+		self.payloads = {}
+		# Tokens written by this bag that may still be the highest, and stale
+		# tokens this bag has asked zookeeper to delete
+		self.token_lock = threading.Lock()
+		self.own_tokens = set()
+		self.swept_tokens = set()
 		self.children = self.connection.children(path + TOKEN_PATH)
 		self.max_token = pettingzoo.utils.max_counter(self.children)
 		self._cleanup_tokens(self.children, self.max_token)
 		self.children(self._process_children_changed)
-		self._populate_ids()
+		if tracking == TRACK_CHILDREN:
+			# Registering fills the bag with the items already present
+			self.item_children = self.connection.children(path + ITEM_PATH)
+			self.item_children(self._process_items_changed)
+		else:
+			self._populate_ids()
 
 	def _populate_ids(self):
-		"""Fills out the bag when initial connection to it is made"""
+		"""
+		Fills out the bag when initial connection to it is made.  The deletion
+		watches for every item are set in parallel without holding the lock,
+		then the ids are added in one step and published as a single change.
+		"""
 		ichildren = self.connection.children(self.path + ITEM_PATH)
+		handlers = {}
+		for child in ichildren:
+			new_id = pettingzoo.utils.counter_value(child)
+			handlers[new_id] = Deleted(
+				self.connection, id_to_item_path(self.path, new_id),
+				[self._process_deleted], watch=False)
+		watched = watch_many(handlers.values())
+		get_logger().info("DistributedBag._populate_ids %s: %s items" % (
+			self.path, len(watched)))
 		with self.lock:
-			for child in ichildren:
-				try:
-					new_id = pettingzoo.utils.counter_value(child)
-					path = id_to_item_path(self.path, new_id)
-					get_logger().info("DistributedBag._on_new_id %s" % (path))
-					self.ids.add(new_id)
-					deleted = Deleted(
-						self.connection, path, [self._process_deleted])
-					self.deletion_handlers[new_id] = deleted
-					for callback in self.add_callbacks:
-						callback(self, new_id)
-				except:
-					exc_class, exc, tback = sys.exc_info()
-					sys.stderr.write(str(exc_class) + "\n")
-					traceback.print_tb(tback)
-					raise exc_class, exc, tback
+			new_ids = []
+			for deleted in watched:
+				new_id = pettingzoo.utils.counter_value(deleted.path)
+				# Skip items already deleted, or added by the token watch
+				if deleted.fired or new_id in self.ids:
+					continue
+				self.ids.add(new_id)
+				self.deletion_handlers[new_id] = deleted
+				new_ids.append(new_id)
+			self._publish(sorted(new_ids), [])
+		self._prefetch(new_ids)
 
 	def _cleanup_tokens(self, children, max_token):
 		"""
@@ -90,18 +154,59 @@ class DistributedBag(object):
 		added as opposed to tracking children in the /items path,
 		especially when /items becomes large.  This method removes
 		any errant tokens if it sees any tokens still in the system
-		smaller then max_token.
-		"""
-		for child in children:
-			token_id = pettingzoo.utils.counter_value(child)
-			if token_id < max_token:
-				get_logger().warning(
-					"DistributedBag._cleanup_tokens %s" % (token_id))
-				try:
-					self.connection.adelete(
-						id_to_token_path(self.path, token_id))
-				except zookeeper.NoNodeException:
-					pass # If it doesn't exist, that's ok
+		smaller then max_token.  It runs from the token children watch, so
+		the deletes are issued asynchronously and add never lists tokens.
+
+		Every bag on the path sees the same events, so only the bag that
+		wrote max_token sweeps, at most TOKEN_SWEEP_BATCH tokens at a time,
+		and it never deletes the same token twice.  Another bag can only
+		delete it again if it writes a higher token while the delete is in
+		flight.  Tokens left by a bag that went away are swept by the next
+		bag to add.
+		"""
+		token_ids = set(
+			pettingzoo.utils.counter_value(child) for child in children)
+		with self.token_lock:
+			self.own_tokens = set(
+				token_id for token_id in self.own_tokens
+					if token_id >= max_token)
+			self.swept_tokens &= token_ids
+			if max_token not in self.own_tokens:
+				return
+			stale = sorted(
+				token_id for token_id in token_ids
+					if token_id < max_token and
+						token_id not in self.swept_tokens)[:TOKEN_SWEEP_BATCH]
+			self.swept_tokens.update(stale)
+		if stale:
+			get_logger().debug(
+				"DistributedBag._cleanup_tokens %s" % (stale))
+		for token_id in stale:
+			self.connection.adelete(
+				id_to_token_path(self.path, token_id), -1,
+				self._token_completion)
+
+	def _write_token(self, item_id):
+		"""
+		Writes the token for item_id asynchronously, remembering that this
+		bag owns it.
+		**Not intended for external use.**
+		"""
+		with self.token_lock:
+			self.own_tokens.add(item_id)
+		self.connection.acreate(
+			id_to_token_path(self.path, item_id), "", zc.zk.OPEN_ACL_UNSAFE,
+			0, self._token_completion)
+
+	def _token_completion(self, handle, status, *args):
+		"""
+		Completion for the asynchronous token create and deletes.  Another
+		participant may already have removed a token, so NONODE is expected.
+		**Not intended for external use.**
+		"""
+		if status not in (zookeeper.OK, zookeeper.NONODE):
+			get_logger().warning("DistributedBag token %s: %s" % (
+				self.path, zookeeper.zerror(status)))
 
 	def add(self, data, ephemeral=True):
 		"""
@@ -120,13 +225,53 @@ class DistributedBag(object):
 			data, zc.zk.OPEN_ACL_UNSAFE, flags)
 		item_id = pettingzoo.utils.counter_value(newpath)
 		get_logger().debug("DistributedBag.add %s: %s" % (item_id, data))
-		self.connection.acreate(
-			id_to_token_path(self.path, item_id), "", zc.zk.OPEN_ACL_UNSAFE)
-		if item_id > 0:
-			children = self.connection.children(self.path + TOKEN_PATH)
-			self._cleanup_tokens(children, item_id)
+		self._write_token(item_id)
 		return item_id
 
+	def add_many(self, payloads, ephemeral=True):
+		"""
+		Inserts many elements into the bag, pipelining the creates.  A single
+		token is written for the highest id, which is enough for every
+		participant to notice all of the new items.
+
+		:param payloads: iterable of values to store, one element each
+		:param ephemeral: if true, elements are automatically deleted when \
+		  backing framework is closed
+		:rtype: *list* of int element ids, where the nth id is the id of the \
+		  nth payload.  The creates complete in any order, so the ids are not \
+		  necessarily increasing.
+
+		If any create fails, the elements that were created are removed again
+		before an Exception is raised, so either every payload is added or
+		none is.
+		"""
+		flags = zookeeper.SEQUENCE
+		if ephemeral:
+			flags = zookeeper.EPHEMERAL | zookeeper.SEQUENCE
+		item_path = self.path + ITEM_PATH + ITEM_PATH
+		results = pettingzoo.utils.run_many([
+			(self.connection.acreate,
+				(item_path, data, zc.zk.OPEN_ACL_UNSAFE, flags))
+			for data in payloads])
+		item_ids = []
+		failures = []
+		for status, args in results:
+			if status == zookeeper.OK:
+				item_ids.append(pettingzoo.utils.counter_value(args[0]))
+			else:
+				failures.append(zookeeper.zerror(status))
+		if failures:
+			# No token has been written, so bags tracking tokens never saw them
+			self.remove_many(item_ids)
+			raise Exception(
+				"DistributedBag.add_many %s failed, %s created were removed: "
+				"%s" % (len(failures), len(item_ids),
+					", ".join(sorted(set(failures)))))
+		get_logger().debug("DistributedBag.add_many %s items" % len(item_ids))
+		if item_ids:
+			self._write_token(max(item_ids))
+		return item_ids
+
 	def remove(self, item_id):
 		"""
 		Remove an item from the bag.
@@ -142,18 +287,105 @@ class DistributedBag(object):
 		except zookeeper.NoNodeException:
 			return False
 
+	def remove_many(self, item_ids):
+		"""
+		Removes many items from the bag, pipelining the deletes.
+
+		:param item_ids: iterable of ids to delete
+		:rtype: *list* of booleans, true for each node that was deleted, \
+		  false for each node that did not exist
+		"""
+		item_ids = list(item_ids)
+		get_logger().debug("DistributedBag.remove_many %s" % item_ids)
+		results = pettingzoo.utils.run_many([
+			(self.connection.adelete,
+				(id_to_item_path(self.path, item_id), -1))
+			for item_id in item_ids])
+		return [status == zookeeper.OK for status, _ in results]
+
 	def get(self, item_id):
 		"""
-		Returns the data payload of a specific item_id's znode
+		Returns the data payload of a specific item_id's znode.  Payloads never
+		change after add, so they are cached until the item is removed.
 
 		:param item_id: to retrieve
 		:rtype: data stored at id (or absent if invalid id)
 		"""
+		try:
+			self.lock.acquire_read()
+			if item_id in self.payloads:
+				return self.payloads[item_id]
+		finally:
+			self.lock.release_read()
 		try:
 			get_logger().debug("DistributedBag.get %s" % item_id)
-			return self.connection.get(id_to_item_path(self.path, item_id))[0]
+			data = self.connection.get(id_to_item_path(self.path, item_id))[0]
 		except zookeeper.NoNodeException:
 			return None
+		self._cache_payloads({item_id: data})
+		return data
+
+	def get_many(self, item_ids):
+		"""
+		Returns the data payloads of many items.  Payloads that are not cached
+		are read from zookeeper in a single pipelined batch.
+
+		:param item_ids: iterable of ids to retrieve
+		:rtype: *dict* of id to data, leaving out ids that do not exist
+
+		**Note**
+
+		This waits on the zookeeper completion thread, so it must not be
+		called from inside a bag callback.
+		"""
+		found = {}
+		paths = {}
+		try:
+			self.lock.acquire_read()
+			for item_id in item_ids:
+				if item_id in self.payloads:
+					found[item_id] = self.payloads[item_id]
+				else:
+					paths[id_to_item_path(self.path, item_id)] = item_id
+		finally:
+			self.lock.release_read()
+		get_logger().debug("DistributedBag.get_many %s cached, %s to read" % (
+			len(found), len(paths)))
+		read = dict(
+			(paths[path], data) for path, (data, _) in
+			pettingzoo.utils.get_many(self.connection, paths).iteritems())
+		self._cache_payloads(read)
+		found.update(read)
+		return found
+
+	def _cache_payloads(self, payloads):
+		"""
+		Stores payloads read from zookeeper, keeping only those of items still
+		in the bag so that removal always evicts them.  This is the only part
+		of a read that takes the write lock.
+		**Not intended for external use.**
+		"""
+		if not payloads:
+			return
+		with self.lock:
+			for item_id, data in payloads.iteritems():
+				if item_id in self.ids:
+					self.payloads[item_id] = data
+
+	def _prefetch(self, item_ids):
+		"""
+		Reads the payloads of item_ids in the background when prefetch is on.
+		**Not intended for external use.**
+		"""
+		if not self.prefetch or not item_ids:
+			return
+		paths = dict(
+			(id_to_item_path(self.path, item_id), item_id)
+			for item_id in item_ids)
+		def completion(results):
+			self._cache_payloads(dict(
+				(paths[path], data) for path, (data, _) in results.iteritems()))
+		pettingzoo.utils.aget_many(self.connection, paths, completion)
 
 	def add_listeners(self, add_callback=None, remove_callback=None):
 		"""
@@ -182,15 +414,95 @@ class DistributedBag(object):
 				self.delete_callbacks.append(remove_callback)
 			return self.get_items()
 
+	def add_batch_listener(self, callback, window=0):
+		"""
+		Adds a callback that is told about changes to the bag in batches.
+
+		:param callback: called as callback(dbag, added_ids, removed_ids), \
+		  where added_ids and removed_ids are frozensets
+		:param window: (Default 0) seconds to gather changes before calling \
+		  callback.  With 0, callback is called once per zookeeper event.
+		:rtype: set of the item ids in the bag when the listener was added
+
+		An item added and removed within the same window is not reported at
+		all.
+		"""
+		with self.lock:
+			get_logger().debug(
+				"DistributedBag.add_batch_listener window %s" % window)
+			self.batch_listeners.append(
+				_BatchListener(self, callback, window))
+			return self.get_items()
+
 	def get_items(self):
 		"""
-		Returns a set of presently existant item ids.
+		Returns the presently existant item ids.  The same frozenset is
+		returned until the bag changes, so this neither locks nor copies
+		except on the first call after a change.
+
+		:rtype: frozenset of integers
+		"""
+		return self.get_snapshot()[1]
+
+	def get_snapshot(self):
+		"""
+		Returns the presently existant item ids together with their version,
+		for use with get_items_since.
+
+		:rtype: (version, frozenset of integers)
+		"""
+		snapshot = self.snapshot
+		if snapshot[0] == self.version:
+			return snapshot
+		try:
+			self.lock.acquire_read()
+			return self._build_snapshot()
+		finally:
+			self.lock.release_read()
+
+	def _build_snapshot(self):
+		"""
+		Returns the snapshot of the current version, building it if the bag
+		changed since the last one.  Must be called while holding the lock.
+		Concurrent readers may each build it, which is harmless.
+		**Not intended for external use.**
+		"""
+		snapshot = self.snapshot
+		if snapshot[0] != self.version:
+			snapshot = (self.version, frozenset(self.ids))
+			self.snapshot = snapshot
+		return snapshot
 
-		:rtype: set of integers
+	def get_items_since(self, version):
+		"""
+		Returns the changes to the bag after version, for consumers that only
+		want deltas.  An id added and removed after version is left out.
+
+		:param version: a version from get_snapshot or get_items_since
+		:rtype: (version, added, removed) where version is the current \
+		  version and added and removed are frozensets.  If version is too old \
+		  to be in the last CHANGE_LOG_SIZE changes, removed is None and added \
+		  holds every id in the bag, meaning the caller should start over.
 		"""
 		try:
 			self.lock.acquire_read()
-			return self.ids.copy()
+			current, items = self._build_snapshot()
+			if version >= current:
+				return current, frozenset(), frozenset()
+			if not self.changes or self.changes[0][0] > version + 1:
+				return current, items, None
+			added = set()
+			removed = set()
+			for change, change_added, change_removed in self.changes:
+				if change <= version:
+					continue
+				for removed_id in change_removed:
+					if removed_id in added:
+						added.discard(removed_id)
+					else:
+						removed.add(removed_id)
+				added.update(change_added)
+			return current, frozenset(added), frozenset(removed)
 		finally:
 			self.lock.release_read()
 
@@ -203,9 +515,11 @@ class DistributedBag(object):
 		get_logger().info("DistributedBag._on_delete_id %s" % (path))
 		with self.lock:
 			try:
+				if removed_id not in self.ids:
+					return False
 				self.ids.remove(removed_id)
-				for callback in self.delete_callbacks:
-					callback(self, removed_id)
+				self.payloads.pop(removed_id, None)
+				return True
 			except:
 				exc_class, exc, tback = sys.exc_info()
 				sys.stderr.write(str(exc_class) + "\n")
@@ -221,12 +535,19 @@ class DistributedBag(object):
 			path = id_to_item_path(self.path, new_id)
 			get_logger().info("DistributedBag._on_new_id %s" % (path))
 			with self.lock:
+				if new_id in self.ids:
+					return False
+				if self.tracking == TRACK_EXISTS:
+					# The watch fires straight away if the item is already
+					# gone, before the id is added, so nothing is published
+					deleted = Deleted(
+						self.connection, path, [self._process_deleted])
+					if deleted.fired:
+						return False
+					self.deletion_handlers[new_id] = deleted
 				self.ids.add(new_id)
-				deleted = Deleted(
-					self.connection, path, [self._process_deleted])
-				self.deletion_handlers[new_id] = deleted
-				for callback in self.add_callbacks:
-					callback(self, new_id)
+				self._prefetch([new_id])
+				return True
 		except:
 			exc_class, exc, tback = sys.exc_info()
 			sys.stderr.write(str(exc_class) + "\n")
@@ -242,10 +563,41 @@ class DistributedBag(object):
 			new_max = pettingzoo.utils.max_counter(children)
 			get_logger().debug(
 				"DistributedBag._process_children_changed %s" % (new_max))
+			self._cleanup_tokens(children, new_max)
+			if self.tracking == TRACK_CHILDREN:
+				return
+			added = []
 			with self.lock:
 				while self.max_token < new_max:
 					self.max_token += 1
-					self._on_new_id(self.max_token)
+					if self._on_new_id(self.max_token):
+						added.append(self.max_token)
+				self._publish(added, [])
+		except:
+			exc_class, exc, tback = sys.exc_info()
+			sys.stderr.write(str(exc) + "\n")
+			traceback.print_tb(tback)
+			raise exc_class, exc, tback
+
+	def _process_items_changed(self, children):
+		"""
+		Callback used for the item Children object in TRACK_CHILDREN mode.
+		**Not intended for external use.**
+		"""
+		try:
+			current = set(
+				pettingzoo.utils.counter_value(child) for child in children)
+			with self.lock:
+				added = sorted(current - self.ids)
+				removed = sorted(self.ids - current)
+				get_logger().debug(
+					"DistributedBag._process_items_changed +%s -%s" % (
+						len(added), len(removed)))
+				removed = [
+					removed_id for removed_id in removed
+					if self._on_delete_id(removed_id)]
+				added = [new_id for new_id in added if self._on_new_id(new_id)]
+				self._publish(added, removed)
 		except:
 			exc_class, exc, tback = sys.exc_info()
 			sys.stderr.write(str(exc) + "\n")
@@ -260,9 +612,74 @@ class DistributedBag(object):
 		del_id = pettingzoo.utils.counter_value(node.path)
 		get_logger().debug(
 			"DistributedBag._process_deleted %s" % (del_id))
-		self._on_delete_id(del_id)
 		with self.lock:
-			del self.deletion_handlers[del_id]
+			if self._on_delete_id(del_id):
+				self._publish([], [del_id])
+			self.deletion_handlers.pop(del_id, None)
+
+	def _publish(self, added, removed):
+		"""
+		Publishes the ids changed by one zookeeper event: bumps the version,
+		logs the change for get_items_since and queues the callbacks.  Must
+		be called while holding the lock, after self.ids has been changed.
+		**Not intended for external use.**
+		"""
+		if not added and not removed:
+			return
+		self.version += 1
+		version = self.version
+		self.changes.append((version, frozenset(added), frozenset(removed)))
+		for removed_id in removed:
+			for callback in self.delete_callbacks:
+				self.dispatcher.submit(self, callback, self, removed_id)
+		for new_id in added:
+			for callback in self.add_callbacks:
+				self.dispatcher.submit(self, callback, self, new_id)
+		for listener in self.batch_listeners:
+			listener.record(added, removed)
+
+class _BatchListener(object):
+	"""
+	Gathers the changes for one batch listener of a DistributedBag and submits
+	them to the bag's dispatcher, either straight away or once window seconds
+	have passed since the first change of the batch.
+	**Not intended for external use.**
+	"""
+	def __init__(self, dbag, callback, window):
+		self.dbag = dbag
+		self.callback = callback
+		self.window = window
+		self.lock = threading.Lock()
+		self.added = set()
+		self.removed = set()
+		self.timer = None
+
+	def record(self, added, removed):
+		with self.lock:
+			for removed_id in removed:
+				if removed_id in self.added:
+					self.added.discard(removed_id)
+				else:
+					self.removed.add(removed_id)
+			self.added.update(added)
+			if not self.window:
+				self._flush()
+			elif self.timer is None:
+				self.timer = threading.Timer(self.window, self.flush)
+				self.timer.daemon = True
+				self.timer.start()
+
+	def flush(self):
+		with self.lock:
+			self._flush()
+
+	def _flush(self):
+		self.timer = None
+		if self.added or self.removed:
+			self.dbag.dispatcher.submit(self.dbag, self.callback, self.dbag,
+				frozenset(self.added), frozenset(self.removed))
+			self.added = set()
+			self.removed = set()
         
 
 def id_to_item_path(path, item_id):
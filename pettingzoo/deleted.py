@@ -4,6 +4,7 @@ import threading
 import sys
 import traceback
 import pettingzoo.testing
+import pettingzoo.utils
 
 class Deleted(zc.zk.NodeInfo):
 	"""
@@ -11,12 +12,18 @@ class Deleted(zc.zk.NodeInfo):
 	"""
 	event_type = zookeeper.DELETED_EVENT
 
-	def __init__(self, session, path, callbacks=[]):
+	def __init__(self, session, path, callbacks=[], watch=True,
+			session_callbacks=[]):
 		zc.zk.ZooKeeper._ZooKeeper__zkfuncs[zookeeper.DELETED_EVENT] = 'exists'
 		self.session = session
 		self.path = path
 		self.callbacks = callbacks
-		self._set_watch()
+		# called with (self, state) when the watch sees a session event
+		self.session_callbacks = session_callbacks
+		self.fired = False
+		self.key = (self.event_type, self.path)
+		if watch:
+			self._set_watch()
 
 	def _set_watch(self):
 		"""
@@ -40,11 +47,25 @@ class Deleted(zc.zk.NodeInfo):
 			self._notify(self.session.exists(self.path))
 
 	def _watch_key(self):
+		"""
+		Internal function, not intended for external calling
+		"""
+		self._handler()(
+			self.session.handle,
+			self.event_type,
+			self.session.state,
+			self.path,
+			True)
+
+	def _handler(self):
 		"""
 		Internal function, not intended for external calling
 		"""
 		zkfunc = getattr(zookeeper, 'exists')
 		def handler(h, t, state, p, reraise=False):
+			if t == zookeeper.SESSION_EVENT:
+				self._session_event(state)
+				return
 			if state != zookeeper.CONNECTED_STATE:
 				zc.zk.logger.warning(
 					"Node watcher event %r with non-connected state, %r",
@@ -78,12 +99,18 @@ class Deleted(zc.zk.NodeInfo):
 					"%s(%s) handler failed", 'exists', self.path)
 				if reraise:
 					raise exc_class, exc, tb
-		handler(
-			self.session.handle,
-			self.event_type,
-			self.session.state,
-			self.path,
-			True)
+		return handler
+
+	def _session_event(self, state):
+		"""
+		Internal function, not intended for external calling
+		"""
+		for callback in list(self.session_callbacks):
+			try:
+				callback(self, state)
+			except Exception:
+				zc.zk.logger.exception(
+					"session watch(%r, %r)", self, callback)
 
 	def _rewatch(self):
 		"""
@@ -99,11 +126,20 @@ class Deleted(zc.zk.NodeInfo):
 			else:
 				self._set_watch()
 
+	def _deleted(self):
+		"""
+		Internal function, not intended for external calling.  zc.zk calls
+		this when the path is gone by the time the watch is set, which for
+		a deletion watch means it has already fired.
+		"""
+		self._notify(None)
+
 	def _notify(self, data):
 		"""
 		Internal function, not intended for external calling
 		"""
 		if data == None:
+			self.fired = True
 			for callback in list(self.callbacks):
 				try:
 					callback(self)
@@ -115,3 +151,36 @@ class Deleted(zc.zk.NodeInfo):
 					else:
 						zc.zk.logger.exception("watch(%r, %r)", self, callback)
 
+def watch_many(watches):
+	"""
+	Sets the watches of many Deleted objects created with watch=False at once,
+	pipelining the exists calls through the zookeeper async api, and waits for
+	all of them.
+
+	:param watches: an iterable of Deleted objects
+	:rtype: *list* of the Deleted objects whose node existed when watched.
+
+	**Note**
+
+	Like pettingzoo.utils.run_many, this must not be called from inside a
+	watch or completion callback.
+	"""
+	watched = []
+	pending = []
+	calls = []
+	for watch in watches:
+		if watch.session.watches.add(watch.key, watch):
+			pending.append(watch)
+			calls.append((zookeeper.aexists,
+				(watch.session.handle, watch.path, watch._handler())))
+		else:
+			watched.append(watch)
+	for watch, (status, _) in zip(pending, pettingzoo.utils.run_many(calls)):
+		if status == zookeeper.OK:
+			watched.append(watch)
+		else:
+			list(watch.session.watches.pop(watch.key))
+			if status != zookeeper.NONODE:
+				pettingzoo.utils.get_logger().warning("watch_many %s: %s" %
+					(watch.path, zookeeper.zerror(status)))
+	return watched
@@ -70,22 +70,74 @@ These files can in turn be used by pettingzoo as a fallback mechanisim if
 zookeeper becomes unavailable for some reason.  It is suggested that you
 run discoverycache as a regular cron job so that your local file system can be
 kept reasonably up to date.
+
+Configs are written to zookeeper as yaml by default.  Writers can instead
+publish json or msgpack (if the msgpack package is installed), which are much
+faster to parse, by passing codec to write_distributed_config or by changing
+DEFAULT_CODEC.  Readers tell the formats apart from the payload itself, so
+json, msgpack and legacy yaml znodes can be mixed under one service.  Since
+json is valid yaml, json configs can also be read by older readers.
 """
 
 from __future__ import absolute_import
 import zc.zk
 import zookeeper
-import yaml
+import json
 import random
+import bisect
+import itertools
+import contextlib
+import copy
+import thread
+import threading
 import pettingzoo.local_config
+import pettingzoo.utils
+from abc import ABCMeta, abstractmethod
 from pettingzoo.utils import get_logger
 
 CONFIG_PATH = "/discovery"
+PARSED_CACHE_SIZE = 4096
+DEFAULT_CODEC = 'yaml'
+WRITE_ATTEMPTS = 3
+
+# Parsed configs shared by every discovery object in the process, keyed by
+# (znode path, mzxid).  The mzxid changes whenever a znode is created or
+# written, so an entry is only reused for an identical payload.  Entries are
+# never changed in place; see _decorate.
+parsed_configs = pettingzoo.utils.LRUCache(PARSED_CACHE_SIZE)
+
+# Addresses found by _get_local_ip, by interface
+_local_ips = {}
+
+def clear_local_ip_cache(interface=None):
+	"""
+	Forgets the local ip addresses looked up to generate the default key of
+	write_distributed_config, for example after an interface changes address.
+
+	:param interface: (Optional) only forget the address of this interface
+	"""
+	if interface == None:
+		_local_ips.clear()
+	else:
+		_local_ips.pop(interface, None)
 
 def _get_local_ip(interface='eth0'):
 	"""
 	Local helper function that returns the local ip address for a
-	given interface.
+	given interface.  Addresses are looked up once per process, until
+	clear_local_ip_cache is called.
+	"""
+	address = _local_ips.get(interface)
+	if address == None:
+		address = _lookup_local_ip(interface)
+		_local_ips[interface] = address
+	return address
+
+def _lookup_local_ip(interface):
+	"""
+	Local helper function that asks the system for the ip address of an
+	interface.  netifaces is only imported here, so importing this module
+	stays cheap.
 	"""
 	from netifaces import interfaces, ifaddresses, AF_INET
 	addresses = {}
@@ -135,6 +187,80 @@ def _znode_path(service_class, service_name, key=None):
 		znarr.append(key)
 	return "/".join(znarr)
 
+def _encode_yaml(config):
+	return pettingzoo.local_config.dump_yaml(config)
+
+def _encode_json(config):
+	return json.dumps(config, separators=(',', ':'))
+
+def _encode_msgpack(config):
+	import msgpack
+	return msgpack.packb(config)
+
+# Writers for each codec.  Payloads are told apart by decode_config from their
+# first byte, so a new codec must not start with a byte used by another.
+ENCODERS = {
+	'yaml': _encode_yaml,
+	'json': _encode_json,
+	'msgpack': _encode_msgpack,
+}
+
+def encode_config(config, codec=None):
+	"""
+	Serialises a discovery config for storage in zookeeper.
+
+	:param config: the config dict
+	:param codec: (Optional) one of the keys of ENCODERS.  Defaults to \
+	  DEFAULT_CODEC.
+	:rtype: *str* the payload
+	"""
+	if codec == None:
+		codec = DEFAULT_CODEC
+	if not ENCODERS.has_key(codec):
+		raise Exception("Unknown discovery config codec: %s" % codec)
+	return ENCODERS[codec](config)
+
+def decode_config(payload):
+	"""
+	Parses a discovery config payload written with any codec in ENCODERS.
+
+	A msgpack map always starts with a byte of 0x80 or above, which cannot
+	start a yaml or json document.  A payload starting with '{' is tried as
+	json first, falling back to yaml for flow style yaml documents.
+
+	:param payload: the znode data
+	:rtype: *dict* the config
+	"""
+	if payload:
+		first = payload[0]
+		if first == '{':
+			try:
+				return json.loads(payload)
+			except ValueError:
+				pass # flow style yaml
+		elif ord(first) >= 0x80:
+			import msgpack
+			return msgpack.unpackb(payload)
+	return pettingzoo.local_config.load_yaml(payload)
+
+def _parse_znode(znode_path, znode):
+	"""
+	Local helper function that returns the parsed config for a (data, stat)
+	pair read from zookeeper, reusing the parse of an unchanged znode.
+	"""
+	data, stat = znode
+	mzxid = None
+	if stat:
+		mzxid = stat.get('mzxid')
+	if mzxid == None:
+		return decode_config(data)
+	key = (znode_path, mzxid)
+	config = parsed_configs.get(key)
+	if config == None:
+		config = decode_config(data)
+		parsed_configs.put(key, config)
+	return config
+
 def _set_metadata(config, service_name, key=None):
 	header = config.setdefault('header', {})
 	metadata = header.setdefault('metadata', {})
@@ -143,6 +269,185 @@ def _set_metadata(config, service_name, key=None):
 		metadata['key'] = key
 	return config
 
+def _decorate(config, service_class, service_name, key=None):
+	"""
+	Local helper function that validates a parsed config and sets its
+	metadata on a copy of it.  Parsed configs are shared through
+	parsed_configs, so they are never changed in place.
+	"""
+	return _set_metadata(validate_config(
+		copy.deepcopy(config), service_class), service_name, key)
+
+def _older(stat, kept):
+	"""
+	Local helper function that returns true if a znode was read at stat
+	before the config kept for it, which was read at kept.
+	"""
+	if not stat or not kept:
+		return False
+	return stat.get('mzxid', 0) < kept.get('mzxid', 0)
+
+def _metadata(config):
+	"""
+	Local helper function that returns the header metadata of a config.
+	"""
+	return config.get('header', {}).get('metadata', {})
+
+def _config_id(config):
+	"""
+	Local helper function that returns a key identifying the service box a
+	config belongs to.
+	"""
+	metadata = _metadata(config)
+	return (config.get('header', {}).get('service_class'),
+		metadata.get('service_name'), metadata.get('key'))
+
+class SelectionStrategy(object):
+	"""
+	Base class for the ways DistributedDiscovery can choose one config out of
+	all the configs available for a service.  select is called on every
+	load_config call with the configs already read for the service, so it must
+	not talk to zookeeper.
+	"""
+	__metaclass__ = ABCMeta
+
+	@abstractmethod
+	def select(self, path, configs):
+		"""
+		Returns one of configs.
+
+		:param path: the znode path of the service
+		:param configs: a non empty sequence of config dicts.  The same \
+		  sequence object is passed in until the configs of the service change.
+		:rtype: *dict* the selected config
+		"""
+
+class RandomSelection(SelectionStrategy):
+	"""
+	Selects a config at random on every call.
+	"""
+	def select(self, path, configs):
+		return random.choice(configs)
+
+class RoundRobinSelection(SelectionStrategy):
+	"""
+	Cycles through the configs of each service, one per call.
+	"""
+	def __init__(self):
+		self.counters = {}
+
+	def select(self, path, configs):
+		counter = self.counters.get(path)
+		if counter == None:
+			counter = self.counters.setdefault(path, itertools.count())
+		return configs[counter.next() % len(configs)]
+
+class WeightedSelection(SelectionStrategy):
+	"""
+	Selects a config at random, weighted by a number in the header metadata of
+	each config.
+
+	:param field: (Default weight) the metadata field holding the weight
+	:param default_weight: (Default 1) weight of configs without the field
+	"""
+	def __init__(self, field='weight', default_weight=1):
+		self.field = field
+		self.default_weight = default_weight
+		self.totals = {}
+
+	def select(self, path, configs):
+		totals = self.totals.get(path)
+		if totals == None or totals[0] is not configs:
+			cumulative = []
+			total = 0
+			for config in configs:
+				total += max(
+					_metadata(config).get(self.field, self.default_weight), 0)
+				cumulative.append(total)
+			totals = (configs, cumulative)
+			self.totals[path] = totals
+		cumulative = totals[1]
+		if not cumulative[-1]:
+			return random.choice(configs)
+		return configs[
+			bisect.bisect_right(cumulative, random.random() * cumulative[-1])]
+
+class LeastLoadedSelection(SelectionStrategy):
+	"""
+	Power of two choices: picks two configs at random and selects the one with
+	fewer requests in flight from this process.  Callers report their requests
+	with begin and end, or with track::
+
+	  config = ddc.load_config('mysql', 'reports')
+	  with strategy.track(config):
+	    run_query(config)
+	"""
+	def __init__(self):
+		self.in_flight = {}
+		self.lock = threading.Lock()
+
+	def select(self, path, configs):
+		if len(configs) == 1:
+			return configs[0]
+		first, second = random.sample(configs, 2)
+		if self.in_flight.get(_config_id(second), 0) < \
+				self.in_flight.get(_config_id(first), 0):
+			return second
+		return first
+
+	def begin(self, config):
+		"""Records the start of a request to the box of config."""
+		key = _config_id(config)
+		with self.lock:
+			self.in_flight[key] = self.in_flight.get(key, 0) + 1
+
+	def end(self, config):
+		"""Records the end of a request to the box of config."""
+		key = _config_id(config)
+		with self.lock:
+			count = self.in_flight.get(key, 0) - 1
+			if count > 0:
+				self.in_flight[key] = count
+			else:
+				self.in_flight.pop(key, None)
+
+	@contextlib.contextmanager
+	def track(self, config):
+		"""Context manager calling begin and end around a request."""
+		self.begin(config)
+		try:
+			yield config
+		finally:
+			self.end(config)
+
+class LocalitySelection(SelectionStrategy):
+	"""
+	Prefers configs whose header metadata field matches locality (for example
+	the rack or zone of this box).  If no config matches, all configs are
+	used.  strategy makes the final choice.
+
+	:param locality: the value to prefer
+	:param field: (Default zone) the metadata field to compare
+	:param strategy: (Default RandomSelection) selects among the preferred \
+	  configs
+	"""
+	def __init__(self, locality, field='zone', strategy=None):
+		self.locality = locality
+		self.field = field
+		if strategy == None:
+			strategy = RandomSelection()
+		self.strategy = strategy
+		self.preferred = {}
+
+	def select(self, path, configs):
+		preferred = self.preferred.get(path)
+		if preferred == None or preferred[0] is not configs:
+			local = tuple(config for config in configs
+				if _metadata(config).get(self.field) == self.locality)
+			preferred = (configs, local or configs)
+			self.preferred[path] = preferred
+		return self.strategy.select(path, preferred[1])
+
 class DistributedDiscovery(object):
 	"""
 	DistributedDiscovery is a class that uses zookeeper to be able to manage the
@@ -159,21 +464,63 @@ class DistributedDiscovery(object):
 	will be executed, selecting a new node at random from the current nodes,
 	allowing the user to reconfigure.
 
+	Configs returned from zookeeper are read only (see
+	pettingzoo.utils.FrozenDict).  The same object is returned by every call
+	until the watch on the service fires, so load_config is cheap enough to be
+	called per request.  Copy the config if you need to change it.
+
+	Configs are parsed once per child and kept in self.configs.  Reading a
+	child also sets a data watch on it.  When the children of a service
+	change, only the children that were added are read.  A child seen
+	before is read again only when its own watch fires, for instance when
+	write_distributed_config deletes and writes its key again.
+
 	:param connection: a zc.zk.ZooKeeper connection
+	:param pipelined: (Default True) When more then one config needs to be \
+	  read, issue all reads at once with the zookeeper async api rather then \
+	  one round trip at a time.
+	:param strategy: (Optional) a SelectionStrategy.  By default one config \
+	  is selected at random and kept until the configs for the service \
+	  change.  With a strategy, every config of the service is read, and \
+	  strategy selects one on every load_config call.
+	:param dispatcher: (Optional) the pettingzoo.utils.Dispatcher that runs \
+	  callbacks.  Defaults to pettingzoo.utils.get_dispatcher().
 
 	**Note**
 
 	Callbacks should be in the form of some_callback(path, config) where path
 	will be passed in as the znode path to the service, and config is the
-	config hash
+	config hash.  They are run by the dispatcher, off the zookeeper event
+	thread, in the order the changes were seen.
 	"""
-	def __init__(self, connection):
+	def __init__(self, connection, pipelined=True, strategy=None,
+			dispatcher=None):
 		self.connection = connection
 		self.connection.create_recursive(
 			CONFIG_PATH, "", acl=zc.zk.OPEN_ACL_UNSAFE)
+		self.pipelined = pipelined
+		self.strategy = strategy
+		self.dispatcher = dispatcher or pettingzoo.utils.get_dispatcher()
 		self.cache = {}
+		# Per path: the parsed config of each child, the stat it was read at,
+		# the children with a data watch set, and the children seen by the
+		# last children event
+		self.configs = {}
+		self.stats = {}
+		self.watched = {}
+		self.child_names = {}
+		self.configs_lock = threading.Lock()
 		self.callbacks = {}
+		# (service_class, service_name) of each path with callbacks, as
+		# service classes may contain slashes
+		self.services = {}
+		# path -> (thread ident, config) while _register_watch sets the watch
+		# on path, as zc.zk calls it right away on the registering thread
+		self.registering = {}
 		self.children = {}
+		self.snapshots = {}
+		self.snapshot_keys = {}
+		self.snapshot_lock = threading.Lock()
 
 	def _get_config_from_cache(self, znode_path, callback=None):
 		if callback:
@@ -182,8 +529,190 @@ class DistributedDiscovery(object):
 		return self.cache.get(znode_path, None)
 
 	def _store_config_in_cache(self, znode_path, config):
-		self.cache[znode_path] = config
-		
+		with self.snapshot_lock:
+			self.cache[znode_path] = config
+			key = self.snapshot_keys.pop(znode_path, None)
+			if key:
+				del self.snapshots[key[0]][key[1]]
+
+	def _get_snapshot(self, znode_path, service_class, service_name, cached):
+		"""
+		Returns the snapshot of cached, taking it only if the watch has
+		replaced the last one.
+		"""
+		snapshots = self.snapshots.get(service_class)
+		if snapshots:
+			snapshot = snapshots.get(service_name)
+			if snapshot != None:
+				return snapshot
+		return self._take_snapshot(
+			znode_path, service_class, service_name, cached)
+
+	def _freeze(self, cached, service_class, service_name):
+		"""
+		Returns the validated, decorated and read only form of a cached
+		config.
+		"""
+		if self.strategy:
+			return tuple(pettingzoo.utils.freeze(
+				_decorate(conf, service_class, service_name, key))
+					for key, conf in cached)
+		return pettingzoo.utils.freeze(_decorate(
+			cached[1], service_class, service_name, cached[0]))
+
+	def _take_snapshot(self, znode_path, service_class, service_name, cached):
+		"""
+		Validates and decorates a cached config once, and keeps the read only
+		result to be returned by load_config until the cache for znode_path
+		changes.
+		"""
+		rconfig = self._freeze(cached, service_class, service_name)
+		with self.snapshot_lock:
+			# Only keep it if the watch has not replaced the config meanwhile
+			if self.cache.get(znode_path) is cached:
+				self.snapshots.setdefault(service_class, {})[service_name] = \
+					rconfig
+				self.snapshot_keys[znode_path] = (service_class, service_name)
+		return rconfig
+
+	def _unwatched(self, path, names):
+		"""
+		Makes names the children of path, dropping the configs of children
+		that left, and returns the znode paths of the children that have no
+		data watch set: new children, and children whose watch fired.  Only
+		those need reading, and they are marked as watched, as reading them
+		sets the watch.  Must be called with configs_lock held.
+		"""
+		self.child_names[path] = names
+		present = set(names)
+		configs = self.configs.setdefault(path, {})
+		stats = self.stats.setdefault(path, {})
+		watched = self.watched.setdefault(path, set())
+		# their watches fire on the deletion, and are then ignored
+		watched &= present
+		for name in [name for name in configs if name not in present]:
+			del configs[name]
+			stats.pop(name, None)
+		unwatched = []
+		for name in names:
+			if name not in watched:
+				watched.add(name)
+				unwatched.append(path + "/" + name)
+		return unwatched
+
+	def _apply_znodes(self, path, znode_paths, znodes):
+		"""
+		Parses the znodes read for znode_paths into the configs for path, and
+		returns a list of (key, config) for every child of path.  Children
+		that went away before they could be read are dropped.  Reads of
+		children that left since, or that are older than the config already
+		kept, are ignored.  Must be called with configs_lock held.
+		"""
+		configs = self.configs.setdefault(path, {})
+		stats = self.stats.setdefault(path, {})
+		watched = self.watched.setdefault(path, set())
+		for znodep in znode_paths:
+			name = znodep.rsplit("/", 1)[1]
+			znode = znodes.get(znodep)
+			if znode == None:
+				configs.pop(name, None)
+				stats.pop(name, None)
+				watched.discard(name)
+			elif name in watched and not _older(znode[1], stats.get(name)):
+				configs[name] = _parse_znode(znodep, znode)
+				stats[name] = znode[1]
+		return [(child, configs[child])
+			for child in self.child_names.get(path, []) if child in configs]
+
+	def _get_sequential(self, znode_paths, watcher):
+		znodes = {}
+		for znodep in znode_paths:
+			try:
+				znodes[znodep] = self.connection.get(znodep, watcher)
+			except zookeeper.NoNodeException:
+				pass # Removed since the children were listed
+		return znodes
+
+	def _update_configs(self, path, znode_paths, znodes):
+		"""
+		Applies the znodes read for znode_paths, and returns a list of
+		(key, config) for every child of path.
+		"""
+		with self.configs_lock:
+			config = self._apply_znodes(path, znode_paths, znodes)
+			if config:
+				self._store_config_in_cache(path, config)
+		return config
+
+	def _make_child_watcher(self, path, notify):
+		"""
+		Returns the data watcher set by reading the children of path.  When a
+		child is deleted or written again, only that child is read again, and
+		notify(path, config) is called as by _refresh_all_znodes.  When the
+		session expires, every child of path is read again by the children
+		event that follows, as the watches expire with it.
+		"""
+		def watcher(handle, event_type, state, znode_path):
+			if event_type == zookeeper.SESSION_EVENT:
+				if state == zookeeper.EXPIRED_SESSION_STATE:
+					with self.configs_lock:
+						self.watched[path] = set()
+				return
+			name = znode_path.rsplit("/", 1)[1]
+			with self.configs_lock:
+				watched = self.watched.get(path, set())
+				if name not in watched:
+					return
+				watched.remove(name)
+				names = self.child_names.get(path, [])
+			self._refresh_all_znodes(path, names, notify)
+		return watcher
+
+	def _load_all_znodes(self, path, names, notify):
+		"""
+		Reads every child of path that has no data watch yet, and returns a
+		list of (key, config) for all of them.  The watches call
+		notify(path, config) whenever a child changes.
+		"""
+		with self.configs_lock:
+			unwatched = self._unwatched(path, names)
+		watcher = self._make_child_watcher(path, notify)
+		if self.pipelined:
+			znodes = pettingzoo.utils.get_many(
+				self.connection, unwatched, watcher=watcher)
+		else:
+			znodes = self._get_sequential(unwatched, watcher)
+		return self._update_configs(path, unwatched, znodes)
+
+	def _refresh_all_znodes(self, path, names, notify):
+		"""
+		Watch version of _load_all_znodes.  Only the children that were added,
+		or whose own watch fired, are read.  Calls notify(path, config) once
+		they have been read.
+		"""
+		with self.configs_lock:
+			unwatched = self._unwatched(path, names)
+		watcher = self._make_child_watcher(path, notify)
+		if not self.pipelined:
+			znodes = self._get_sequential(unwatched, watcher)
+			notify(path, self._update_configs(path, unwatched, znodes))
+			return
+		# This runs on the zookeeper event thread, so the reads must not be
+		# waited on here.  notify is called once they have completed.
+		def on_loaded(znodes):
+			notify(path, self._update_configs(path, unwatched, znodes))
+		try:
+			pettingzoo.utils.aget_many(
+				self.connection, unwatched, on_loaded, watcher)
+		except Exception, e:
+			# the connection was closed, so read them on the next event
+			with self.configs_lock:
+				watched = self.watched.get(path, set())
+				for znodep in unwatched:
+					watched.discard(znodep.rsplit("/", 1)[1])
+			get_logger().warning(
+				"DistributedConfig could not refresh %s: %s" % (path, e))
+
 	def load_config(self, service_class, service_name, callback=None):
 		"""
 		Returns a config using the fallback scheme for the class to select
@@ -198,25 +727,42 @@ class DistributedDiscovery(object):
 		:rtype: *dict* The dict of the config in the standard pettingzoo \
 		  format.
 		"""
+		if callback:
+			# A snapshot is only kept while the watch on the service is set,
+			# so the callback only needs registering before it is returned
+			path = _znode_path(service_class, service_name)
+			self.services[path] = (service_class, service_name)
+			self._get_config_from_cache(path, callback)
+		# Fast path: nothing is allocated, locked or logged here.
+		snapshots = self.snapshots.get(service_class)
+		if snapshots:
+			snapshot = snapshots.get(service_name)
+			if snapshot != None:
+				if self.strategy == None:
+					return snapshot
+				return self.strategy.select(
+					_znode_path(service_class, service_name), snapshot)
 		path = _znode_path(service_class, service_name)
-		cached = self._get_config_from_cache(path, callback)
+		cached = self._get_config_from_cache(path)
 		if cached:
-			get_logger().info("DistributedConfig.load_config %s/%s (cached)" %
-				(service_class, service_name))
-			rconfig = _set_metadata(
-				validate_config(cached[1], service_class),
-				service_name, cached[0])
-			get_logger().debug("%s" % (rconfig))
+			get_logger().info("DistributedConfig.load_config %s/%s (cached)",
+				service_class, service_name)
+			rconfig = self._take_snapshot(
+				path, service_class, service_name, cached)
+			if self.strategy:
+				rconfig = self.strategy.select(path, rconfig)
+			get_logger().debug("%s", rconfig)
 			return rconfig
 		config = self._load_znodes(path)
 		if config:
 			get_logger().info(
-				"DistributedConfig.load_config %s/%s (zookeeper)" %
-					(service_class, service_name))
-			rconfig = _set_metadata(
-				validate_config(config[1], service_class),
-				service_name, config[0])
-			get_logger().debug("%s" % (rconfig))
+				"DistributedConfig.load_config %s/%s (zookeeper)",
+					service_class, service_name)
+			rconfig = self._take_snapshot(
+				path, service_class, service_name, config)
+			if self.strategy:
+				rconfig = self.strategy.select(path, rconfig)
+			get_logger().debug("%s", rconfig)
 			return rconfig
 		config = self._load_file_config(service_class, service_name)
 		get_logger().info("DistributedConfig.load_config %s/%s (file)" %
@@ -274,15 +820,68 @@ class DistributedDiscovery(object):
 			(path, add_callback))
 		if self.connection.exists(path):
 			children = self.connection.children(path)
-			if add_callback:
-				children(self._child_callback)
-				self.children[path] = children
+			config = None
 			if len(children) > 0:
-				selectee = random.choice([c for c in children])
-				znode = path + "/" + selectee
-				config = (selectee, yaml.load(self.connection.get(znode)[0]))
-				self._store_config_in_cache(path, config)
-				return config
+				if self.strategy:
+					config = self._load_all_znodes(
+						path, list(children), self._notify_selected) or None
+				else:
+					config = self._select_znode(path, list(children))
+			if add_callback:
+				self._register_watch(path, children, config)
+			return config
+
+	def _register_watch(self, path, children, config):
+		"""
+		Sets the children watch on path.  zc.zk calls _child_callback right
+		away, which hands config, just loaded by the caller, to the callbacks
+		on this thread instead of reading it again and dispatching it.
+		"""
+		self.registering[path] = (thread.get_ident(), config)
+		try:
+			children(self._child_callback)
+		finally:
+			del self.registering[path]
+		self.children[path] = children
+
+	def _registering(self, path):
+		"""
+		Returns true if this thread is inside _register_watch for path.
+		"""
+		registering = self.registering.get(path)
+		return registering != None and registering[0] == thread.get_ident()
+
+	def _dispatch(self, path, callback, config):
+		"""
+		Queues callback(path, config) on the dispatcher, or runs it right
+		away when set off by load_config registering its watch, which is
+		never the zookeeper event thread.
+		"""
+		if not self._registering(path):
+			self.dispatcher.submit(self, callback, path, config)
+			return
+		try:
+			callback(path, config)
+		except Exception:
+			get_logger().exception(
+				"DistributedConfig callback %r failed" % (callback,))
+
+	def _select_znode(self, path, names):
+		"""
+		Selects a child at random.  Only the selected child is read, so a
+		key that was written again is picked up; parsing it again is avoided
+		by parsed_configs if it did not change.
+		"""
+		selectee = random.choice(names)
+		znode = path + "/" + selectee
+		config = (selectee, _parse_znode(znode, self.connection.get(znode)))
+		with self.configs_lock:
+			configs = self.configs.get(path, {})
+			self.configs[path] = dict((name, configs[name])
+				for name in names if name in configs)
+			self.configs[path][selectee] = config[1]
+			self._store_config_in_cache(path, config)
+		return config
 
 	def load_config_via_path(self, path, callback=None):
 		"""
@@ -316,10 +915,30 @@ class DistributedDiscovery(object):
 
 	def _child_callback(self, children):
 		path = children.path
-		service_class, service_name = _znode_to_class_and_name(path)
-		config = self._load_znodes(path, add_callback=False)
+		if self.strategy:
+			get_logger().info("DistributedConfig._child_callback: %s", path)
+			if self._registering(path):
+				self._notify_selected(path, self.registering[path][1])
+			else:
+				self._refresh_all_znodes(
+					path, list(children), self._notify_selected)
+			return
+		names = list(children)
+		config = None
+		if self._registering(path):
+			config = self.registering[path][1]
+		elif names:
+			config = self._select_znode(path, names)
+		else:
+			with self.configs_lock:
+				self.configs[path] = {}
 		callbacks = self.callbacks.get(path, [])
 		get_logger().info("DistributedConfig._child_callback: %s" % (path))
+		if config and callbacks:
+			# the read only snapshot, as parsed configs are shared
+			service_class, service_name = self.services[path]
+			config = (config[0], self._get_snapshot(
+				path, service_class, service_name, config))
 		for callback in callbacks:
 			conf = None
 			if config:
@@ -327,7 +946,25 @@ class DistributedDiscovery(object):
 			else:
 				get_logger().warning(
 					"DistributedConfig._child_callback: NO CONFIGS AVAILABLE")
-			callback(path, conf)
+			self._dispatch(path, callback, conf)
+
+	def _notify_selected(self, path, config):
+		callbacks = self.callbacks.get(path, [])
+		snapshot = None
+		if config and callbacks:
+			# The same read only sequence load_config selects from, so that
+			# strategies keep their state across callbacks and calls
+			service_class, service_name = self.services[path]
+			snapshot = self._get_snapshot(
+				path, service_class, service_name, config)
+		for callback in callbacks:
+			conf = None
+			if snapshot:
+				conf = self.strategy.select(path, snapshot)
+			else:
+				get_logger().warning(
+					"DistributedConfig._child_callback: NO CONFIGS AVAILABLE")
+			self._dispatch(path, callback, conf)
 
 class DistributedMultiDiscovery(DistributedDiscovery):
 	"""
@@ -346,7 +983,15 @@ class DistributedMultiDiscovery(DistributedDiscovery):
 	to reconfigure.  Refer to DistributedConfig for the majority of this class's
 	methods.
 
+	Configs from zookeeper are validated and decorated once per change of
+	the service, like the snapshots of DistributedDiscovery.  Every call
+	and callback gets a new list of shallow copies of them: the top level
+	of each config can be changed, but the dicts inside it, such as the
+	header, are read only (see pettingzoo.utils.FrozenDict).
+
 	:param connection: a zc.zk.ZooKeeper connection
+	:param pipelined: (Default True) Read all configs for a service at once \
+	  with the zookeeper async api rather then one round trip at a time.
 
 	**Note**
 	callbacks should be in the form of some_callback(path, config) where path
@@ -369,28 +1014,24 @@ class DistributedMultiDiscovery(DistributedDiscovery):
 		  config format.
 		"""
 		path = _znode_path(service_class, service_name)
+		if callback:
+			self.services[path] = (service_class, service_name)
 		cached = self._get_config_from_cache(path, callback)
 		if cached:
 			get_logger().info(
-				"DistributedMultiConfig.load_config: %s/%s (cached)" %
-					(service_class, service_name))
-			rconfig = [
-				_set_metadata(
-					validate_config(conf[1], service_class),
-					service_name, conf[0])
-						for conf in cached]
-			get_logger().debug("%s" % (rconfig))
+				"DistributedMultiConfig.load_config: %s/%s (cached)",
+					service_class, service_name)
+			rconfig = [dict(conf) for conf in self._get_snapshot(
+				path, service_class, service_name, cached)]
+			get_logger().debug("%s", rconfig)
 			return rconfig
 		config = self._load_znodes(path)
 		if config:
 			get_logger().info(
 				"DistributedMultiConfig.load_config: %s/%s (zookeeper)" %
 					(service_class, service_name))
-			rconfig = [
-				_set_metadata(
-					validate_config(conf[1], service_class),
-					service_name, conf[0])
-						for conf in config]
+			rconfig = [dict(conf) for conf in self._get_snapshot(
+				path, service_class, service_name, config)]
 			get_logger().debug("%s" % (rconfig))
 			return rconfig
 		config = self._load_file_config(service_class, service_name)
@@ -403,23 +1044,28 @@ class DistributedMultiDiscovery(DistributedDiscovery):
 		get_logger().debug("%s" % (rconfig))
 		return rconfig
 
+	def _freeze(self, cached, service_class, service_name):
+		"""
+		See DistributedDiscovery._freeze.  Every config of the service is
+		kept.
+		"""
+		return tuple(pettingzoo.utils.freeze(
+			_decorate(conf, service_class, service_name, key))
+				for key, conf in cached)
+
 	def _load_znodes(self, path, add_callback=True):
 		get_logger().info(
 			"DistributedMultiConfig._load_znodes: %s. Callback: %s" %
 				(path, add_callback))
 		if self.connection.exists(path):
 			children = self.connection.children(path)
-			if add_callback:
-				children(self._child_callback)
-				self.children[path] = children
+			config = None
 			if len(children) > 0:
-				config = []
-				for child in children:
-					znodep = path + "/" + child
-					znode = self.connection.get(znodep)
-					single = yaml.load(znode[0])
-					config.append((child, single))
-				self._store_config_in_cache(path, config)
+				config = self._load_all_znodes(
+					path, list(children), self._notify_callbacks)
+			if add_callback:
+				self._register_watch(path, children, config)
+			if config:
 				return config
 
 	def _load_file_config(self, service_class, service_name):
@@ -433,19 +1079,32 @@ class DistributedMultiDiscovery(DistributedDiscovery):
 	def _child_callback(self, children):
 		path = children.path
 		get_logger().info("DistributedMultiConfig._child_callback: %s" % (path))
-		config = self._load_znodes(path, add_callback=False)
+		if self._registering(path):
+			self._notify_callbacks(path, self.registering[path][1])
+			return
+		# Only children that were added are read.  Configs for children that
+		# left are dropped by _unwatched.
+		self._refresh_all_znodes(path, list(children), self._notify_callbacks)
+
+	def _notify_callbacks(self, path, config):
 		callbacks = self.callbacks.get(path, [])
+		snapshot = None
+		if config and callbacks:
+			service_class, service_name = self.services[path]
+			snapshot = self._get_snapshot(
+				path, service_class, service_name, config)
 		for callback in callbacks:
 			config_list = []
-			if config:
-				config_list = [conf[1] for conf in config]
+			if snapshot:
+				# each callback gets its own list, like load_config
+				config_list = [dict(conf) for conf in snapshot]
 			else:
 				get_logger().warning(
 					"DistributedConfig._child_callback: NO CONFIGS AVAILABLE")
-			callback(path, config_list)
+			self._dispatch(path, callback, config_list)
 
 def write_distributed_config(connection, service_class, service_name, config,
-		key=None, interface='eth0', ephemeral=True):
+		key=None, interface='eth0', ephemeral=True, codec=None):
 	"""
 	Writes a discovery config file out to zookeeper.
 
@@ -467,6 +1126,8 @@ def write_distributed_config(connection, service_class, service_name, config,
 	  be written to zookeeper as an ephemeral node or not.  Practically what \
 	  this means is that if your zookeeper connection closes, zookeeper will \
 	  automatically remove the config.  You generally want this to be True.
+	:param codec: (Optional) the format to write the config in: 'yaml', \
+	  'json' or 'msgpack'.  Defaults to DEFAULT_CODEC.
 	:rtype: *str* the key
 	"""
 	if not key:
@@ -477,7 +1138,7 @@ def write_distributed_config(connection, service_class, service_name, config,
 		validate_config(config, service_class),
 		service_name,
 		key)
-	payload = yaml.dump(config)
+	payload = encode_config(config, codec)
 	flags = 0
 	if ephemeral:
 		flags = zookeeper.EPHEMERAL
@@ -490,6 +1151,76 @@ def write_distributed_config(connection, service_class, service_name, config,
 	get_logger().debug("%s" % (config))
 	return key
 
+def write_distributed_configs(connection, configs, key=None, interface='eth0',
+		ephemeral=True, codec=None):
+	"""
+	Writes many discovery configs out to zookeeper at once, for a box that
+	provides several services.  All znodes are created with pipelined async
+	calls, so when the service paths already exist and the configs do not, the
+	whole registration costs one round trip.  Missing service paths are
+	created, and existing configs under the same key are replaced, as with
+	write_distributed_config.
+
+	:param connection: a zc.zk.ZooKeeper connection
+	:param configs: an iterable of (service_class, service_name, config) \
+	  tuples, following the same rules as write_distributed_config.
+	:param key: (Optional) the key for every config.  Defaults to the ip \
+	  address of interface.
+	:param interface: (Default eth0) the networking device used to generate \
+	  the key
+	:param ephemeral: (Default True) whether the configs are written as \
+	  ephemeral nodes
+	:param codec: (Optional) the format to write the configs in.  Defaults \
+	  to DEFAULT_CODEC.
+	:rtype: *str* the key
+
+	**Note**
+
+	This waits on async completions, so unlike write_distributed_config it
+	must not be called from inside a watch callback.
+	"""
+	if not key:
+		key = _get_local_ip(interface)
+	flags = 0
+	if ephemeral:
+		flags = zookeeper.EPHEMERAL
+	payloads = {}
+	for service_class, service_name, config in configs:
+		config = _set_metadata(
+			validate_config(config, service_class), service_name, key)
+		payloads[_znode_path(service_class, service_name, key)] = \
+			encode_config(config, codec)
+	pending = sorted(payloads.keys())
+	for attempt in range(WRITE_ATTEMPTS):
+		if not pending:
+			break
+		results = pettingzoo.utils.run_many([
+			(connection.acreate,
+				(znode, payloads[znode], zc.zk.OPEN_ACL_UNSAFE, flags))
+					for znode in pending])
+		missing = []
+		existing = []
+		for znode, (status, result) in zip(pending, results):
+			if status == zookeeper.NONODE:
+				missing.append(znode)
+			elif status == zookeeper.NODEEXISTS:
+				existing.append(znode)
+			elif status != zookeeper.OK:
+				raise Exception("write_distributed_configs %s: %s" %
+					(znode, zookeeper.zerror(status)))
+		for znode in missing:
+			connection.create_recursive(
+				znode.rsplit("/", 1)[0], "", acl=zc.zk.OPEN_ACL_UNSAFE)
+		pettingzoo.utils.run_many([
+			(connection.adelete, (znode, -1)) for znode in existing])
+		pending = missing + existing
+	if pending:
+		raise Exception(
+			"write_distributed_configs could not write %s" % pending)
+	get_logger().info("write_distributed_configs: %s configs, Key: %s, "
+		"Ephemeral: %s", len(payloads), key, ephemeral)
+	return key
+
 def remove_stale_config(connection, service_class, service_name, key):
 	"""
 	This function manually removes a discovery config from zookeeeper.  This can
@@ -1,31 +1,72 @@
 import zc.zk
 import zookeeper
-import multiprocessing
+import bisect
+import random
 import sys
+import threading
+import time
 import traceback
 import pettingzoo.utils
 import logging
 from abc import ABCMeta, abstractmethod
-from pettingzoo.deleted import Deleted
+from pettingzoo.deleted import Deleted, watch_many
 from pettingzoo.utils import get_logger
 
 PREFIX = "/candidate"
 logger = logging.getLogger('leader_queue')
 
 class LeaderQueue(object):
-	def __init__(self, connection, path):
+	def __init__(self, connection, path, dispatcher=None, lock=None,
+			create_path=True):
 		#zk connection
 		self.connection = connection
 		self.path = path
+		# runs on_elected off the zookeeper event thread
+		self.dispatcher = dispatcher or pettingzoo.utils.get_dispatcher()
 		self.deletion_handlers = {}
-		# Ensures path exists
-		self.connection.create_recursive(
-			self.path + PREFIX, "", acl=zc.zk.OPEN_ACL_UNSAFE)
-		self.lock = multiprocessing.RLock()
+		# Ensures path exists, unless a LeaderQueueGroup already made it
+		if create_path:
+			self.connection.create_recursive(
+				self.path + PREFIX, "", acl=zc.zk.OPEN_ACL_UNSAFE)
+		# Guards in process state only: no zookeeper call is made while it is
+		# held, and it is never taken twice by the same thread.  May be shared
+		# by the queues of a LeaderQueueGroup.
+		self.lock = lock or threading.Lock()
 		# Stores leader queues
 		self.candidate_by_predecessor = {}
+		self.predecessor_by_candidate = {}
 		self.counter_by_candidate = {}
-			
+		# candidates whose asynchronous create has not finished yet
+		self.pending_candidates = set()
+		# Sorted counters of every candidate in the queue, kept up to date by
+		# one children watch so finding a predecessor needs no listing
+		self.counters = []
+		# child names the counter index was last built from
+		self.child_names = frozenset()
+		# called with (candidate, seconds) after each handoff
+		self.handoff_listeners = []
+		# Candidates currently elected.  Replaced, never mutated, so
+		# is_leader can read it without the lock.
+		self.leaders = frozenset()
+		# last session state seen by a deletion watch
+		self.session_state = zookeeper.CONNECTED_STATE
+		self.children = self.connection.children(self.path + PREFIX)
+		self.children(self._process_children_changed)
+
+	def add_handoff_listener(self, callback):
+		"""
+		Adds a callback for leadership handoffs.  After a candidate's
+		on_elected returns because its predecessor went away, callback is
+		called with the candidate and the seconds from noticing the deletion
+		to the end of on_elected.  Candidates elected on being added are not
+		reported.
+
+		:param callback: function taking (candidate, seconds)
+		:rtype: None
+		"""
+		with self.lock:
+			self.handoff_listeners.append(callback)
+
 	def remove_candidate(self, candidate):
 		'''
 		Removes candidate from zookeeper and updates leader queues to
@@ -34,20 +75,27 @@ class LeaderQueue(object):
 		:param path: string. path to deleted node
 		:rtype: True if successful, False otherwise
 		'''
+		started = time.time()
 		#create node in ZK. Node will be delete when backing framework is closed
 		with self.lock:
 			del_id = self.counter_by_candidate.get(candidate, None)
-			get_logger().info("LeaderQueue.remove_candidate %s" % (del_id))
-			if del_id == None:
-				return False
+		get_logger().info("LeaderQueue.remove_candidate %s" % (del_id))
+		if del_id == None:
+			return False
 		try:
 			# delete node
 			self.connection.delete(id_to_item_path(self.path, del_id))
 			# update the leader queues
-			self._handle_remove(del_id)
+			self._handle_remove(del_id, started)
 			#cleanup hashes
 			with self.lock:
-				del self.counter_by_candidate[candidate]
+				self.counter_by_candidate.pop(candidate, None)
+				if candidate in self.leaders:
+					self.leaders = self.leaders - set([candidate])
+				# so a removed candidate is not elected when its predecessor goes
+				pred_id = self.predecessor_by_candidate.pop(candidate, None)
+				if self.candidate_by_predecessor.get(pred_id, None) is candidate:
+					del self.candidate_by_predecessor[pred_id]
 				return True
 		except zookeeper.NoNodeException:
 			return False 
@@ -61,12 +109,18 @@ class LeaderQueue(object):
 		:param meta_data: binary data to store on node
 		:rtype: True if operation successfully completed. False otherwise
 		'''
-		#ensure candidate is not already in queue
-		if self.has_candidate(candidate):
+		#ensure candidate is not already in queue, and keep it that way
+		#while its node is created
+		with self.lock:
+			known = (self.counter_by_candidate.has_key(candidate)
+				or candidate in self.pending_candidates)
+			if not known:
+				self.pending_candidates.add(candidate)
+		if known:
 			get_logger().warning(
 				"LeaderQueue.remove_candidate Candidate already in queue.")
 			return False
-		else:
+		try:
 			#create node in ZK. Node will be deleted when connection is closed
 			flags = zookeeper.EPHEMERAL | zookeeper.SEQUENCE
 			newpath = self.connection.create(
@@ -84,14 +138,143 @@ class LeaderQueue(object):
 				sys.stderr.write(str(exc_class) + "\n")
 				traceback.print_tb(tback)
 				raise exc_class, exc, tback
-			with self.lock:	
+			with self.lock:
 				self.counter_by_candidate[candidate] = counter
+		finally:
+			with self.lock:
+				self.pending_candidates.discard(candidate)
+		self._handle_add(counter, candidate)
+		return True
+
+	def add_candidate_async(self, candidate, meta_data=None):
+		'''
+		Adds new candidate to zookeeper without waiting for zookeeper.
+		Like add_candidate, candidate.on_elected is called once it is
+		elected.
+
+		:param candidate: object that represents the candidate in the queue
+		:param meta_data: binary data to store on node
+		:rtype: pettingzoo.utils.Future whose result is True once the \
+		  candidate is in the queue, or False if it already was
+		'''
+		return self.add_candidates([candidate], meta_data)[0]
+
+	def add_candidates(self, candidates, meta_data=None):
+		'''
+		Adds many candidates at once.  Their nodes are created with pipelined
+		async calls, so enrolling a candidate per shard costs about one round
+		trip rather than several per candidate.  Once every node is created,
+		the dispatcher sets their deletion watches with pipelined calls too,
+		and looks up their predecessors, off the zookeeper event thread.
+
+		:param candidates: iterable of candidates
+		:param meta_data: binary data to store on every node
+		:rtype: *list* of pettingzoo.utils.Future, one per candidate, as \
+		  returned by add_candidate_async
+		'''
+		futures = []
+		enrolling = []
+		flags = zookeeper.EPHEMERAL | zookeeper.SEQUENCE
+		for candidate in candidates:
+			future = pettingzoo.utils.Future()
+			futures.append(future)
+			with self.lock:
+				if (self.counter_by_candidate.has_key(candidate)
+						or candidate in self.pending_candidates):
+					get_logger().warning(
+						"LeaderQueue.add_candidates Candidate already in queue.")
+					future.set_result(False)
+					continue
+				self.pending_candidates.add(candidate)
+			enrolling.append((candidate, future))
+		# (candidate, counter, future) of every node created, and the number
+		# of creates still in flight
+		batch = {'created': [], 'pending': len(enrolling)}
+		for candidate, future in enrolling:
+			self.connection.acreate(
+				self.path + PREFIX + PREFIX, meta_data, zc.zk.OPEN_ACL_UNSAFE,
+				flags, self._make_create_completion(candidate, future, batch))
+		return futures
+
+	def _make_create_completion(self, candidate, future, batch):
+		"""
+		Internal only. Returns the acreate completion for one candidate of
+		add_candidates.  It runs on the zookeeper completion thread, so the
+		last create of the batch only hands the rest of the work to the
+		dispatcher.
+		"""
+		def completion(handle, status, path=None):
+			if status != zookeeper.OK:
+				future.set_exception(Exception(
+					"LeaderQueue.add_candidates %s" % zookeeper.zerror(status)))
+			with self.lock:
+				if status != zookeeper.OK:
+					self.pending_candidates.discard(candidate)
+				else:
+					batch['created'].append((
+						candidate, pettingzoo.utils.counter_value(path), future))
+				batch['pending'] -= 1
+				if batch['pending'] or not batch['created']:
+					return
+			self.dispatcher.submit(self, self._enrol, batch['created'])
+		return completion
+
+	def _enrol(self, created):
+		"""
+		Internal only. Finishes adding the candidates created by one call to
+		add_candidates.  Their deletion watches are set at once, with
+		pipelined calls, before they are enrolled in the order of their
+		nodes.
+
+		:param created: list of (candidate, counter, future)
+		"""
+		created = sorted(created, key=lambda entry: entry[1])
+		get_logger().info("LeaderQueue._enrol %s" % (
+			[counter for candidate, counter, future in created]))
+		try:
+			watched = self._create_deletion_handlers_many(
+				[counter for candidate, counter, future in created])
+		except Exception, exc:
+			with self.lock:
+				for candidate, counter, future in created:
+					self.pending_candidates.discard(candidate)
+			for candidate, counter, future in created:
+				future.set_exception(exc)
+			return
+		for candidate, counter, future in created:
+			if counter not in watched:
+				# the node went away before it could be watched
+				with self.lock:
+					self.pending_candidates.discard(candidate)
+				future.set_result(False)
+				continue
+			try:
+				with self.lock:
+					self.pending_candidates.discard(candidate)
+					self.counter_by_candidate[candidate] = counter
 				self._handle_add(counter, candidate)
-			return True
+			except Exception, exc:
+				future.set_exception(exc)
+				continue
+			future.set_result(True)
+
+	def is_leader(self, candidate):
+		'''
+		Checks whether candidate is leader, from local state only.  It is
+		cheap enough to call before every unit of work: it takes no lock
+		and makes no zookeeper call.  Leadership is revoked as soon as the
+		connection is lost, and given back by on_elected if the candidate is
+		still first in line once it reconnects.
+
+		:param candidate:
+		:rtype: True if candidate is elected and connected, False otherwise
+		'''
+		return candidate in self.leaders and self.connection.connected.is_set()
 
 	def has_candidate(self, candidate):
 		'''
-		Checks to see if zookeeper knows about a candidate
+		Checks to see if zookeeper knows about a candidate.  Candidates are
+		dropped when the session expires, and can then be added again.
 
 		:param candidate:
 		:rtype: True if candidate exists, False if otherwise
@@ -99,38 +282,107 @@ class LeaderQueue(object):
 		with self.lock:
 			return self.counter_by_candidate.has_key(candidate)
 
+	def _process_children_changed(self, children):
+		"""
+		Callback used for the Children object.  Updates the counter index
+		with the children added and removed since the last call, so only
+		those names are parsed.
+		Not intended for external use.
+		"""
+		names = frozenset(children)
+		with self.lock:
+			added = names - self.child_names
+			removed = self.child_names - names
+			self.child_names = names
+			for name in removed:
+				counter = pettingzoo.utils.counter_value(name)
+				index = bisect.bisect_left(self.counters, counter)
+				if index < len(self.counters) and self.counters[index] == counter:
+					del self.counters[index]
+			for name in added:
+				counter = pettingzoo.utils.counter_value(name)
+				index = bisect.bisect_left(self.counters, counter)
+				if index == len(self.counters) or self.counters[index] != counter:
+					self.counters.insert(index, counter)
+
+	def _find_predecessor(self, counter):
+		"""
+		Internal only. Returns the largest counter in the queue that is
+		smaller than counter, or -1 if there is none.
+
+		:param counter: (int) counter of the candidate
+		:rtype: int
+		"""
+		with self.lock:
+			index = bisect.bisect_left(self.counters, counter)
+			if index < len(self.counters) and self.counters[index] == counter:
+				if index:
+					return self.counters[index - 1]
+				return -1
+		# The watch has not seen this candidate yet, so the index may be
+		# missing candidates created just before it.  List them once.
+		get_logger().debug(
+			"LeaderQueue._find_predecessor %s not indexed" % (counter))
+		children = self.connection.get_children(self.path + PREFIX)
+		with self.lock:
+			known = set(self.counters)
+			known.update(
+				pettingzoo.utils.counter_value(child) for child in children)
+			self.counters = sorted(known)
+			index = bisect.bisect_left(self.counters, counter)
+			if index:
+				return self.counters[index - 1]
+			return -1
+
+	def _remove_counter(self, counter):
+		"""
+		Internal only. Drops counter from the index, without waiting for the
+		children watch.
+
+		:param counter: (int) counter of a deleted candidate
+		:rtype: None
+		"""
+		with self.lock:
+			index = bisect.bisect_left(self.counters, counter)
+			if index < len(self.counters) and self.counters[index] == counter:
+				del self.counters[index]
+
 	def _process_deleted(self, node):
 		"""
 		Callback used for Exists object.
 		Not intended for external use.
 		"""
+		started = time.time()
 		del_id = pettingzoo.utils.counter_value(node.path)
 		get_logger().debug("LeaderQueue._process_deleted %s" % (del_id))
-		self._handle_remove(del_id) 
+		self._handle_remove(del_id, started)
 		with self.lock:
-			del self.deletion_handlers[del_id]
+			self.deletion_handlers.pop(del_id, None)
 	
-	def _handle_remove(self, del_id): 
+	def _handle_remove(self, del_id, started=None):
 		'''
 		Called on delete. Updates the candidate by predecessor dict.
 
 		:param del_id: (int) id of deleted candidate
+		:param started: time.time() at which the deletion was noticed
 		:rtype: None
 		'''
 
+		self._remove_counter(del_id)
 		with self.lock:
-			candidate = self.candidate_by_predecessor.get(del_id, None)
-			if del_id == None:
-				get_logger().warning(
-					"LeaderQueue._handle_remove Unknown candidate %s" %
-					(del_id))
-			elif candidate == None: 
-				get_logger().debug(
-					"LeaderQueue._handle_remove Removed candidate is not"
-					+ " a predecessor %s" % (del_id))
-			else:
-				self._update_predecessor_dict(del_id, candidate)
-				del self.candidate_by_predecessor[del_id]
+			candidate = self.candidate_by_predecessor.pop(del_id, None)
+			# look up from the candidate's own counter, which is still indexed
+			counter = self.counter_by_candidate.get(candidate, del_id)
+		if del_id == None:
+			get_logger().warning(
+				"LeaderQueue._handle_remove Unknown candidate %s" %
+				(del_id))
+		elif candidate == None: 
+			get_logger().debug(
+				"LeaderQueue._handle_remove Removed candidate is not"
+				+ " a predecessor %s" % (del_id))
+		else:
+			self._update_predecessor_dict(counter, candidate, started)
 		return None
 
 	def _create_deletion_handlers(self, counter):
@@ -138,17 +390,49 @@ class LeaderQueue(object):
 		Called on create and update. creates delete watch on node.
 
 		:param counter: (int) id of node to watch
-		:rtype: None
+		:rtype: False if the node is already gone, True otherwise
 		'''
 		with self.lock:
 			# check watch does not already exist
-			if self.deletion_handlers.get(counter, None) == None: 
-				path = id_to_item_path(self.path, counter)
-				delete_watch = Deleted(
-					self.connection, path, [self._process_deleted])
+			if self.deletion_handlers.get(counter, None) != None:
+				return True
+		# The watch is set without holding the lock, as watch callbacks take it
+		path = id_to_item_path(self.path, counter)
+		delete_watch = Deleted(
+			self.connection, path, [self._process_deleted],
+			session_callbacks=[self._process_session_event])
+		with self.lock:
+			# stuff it on the object to make sure the watch still exists
+			if not delete_watch.fired:
+				self.deletion_handlers.setdefault(counter, delete_watch)
+		return not delete_watch.fired
+
+	def _create_deletion_handlers_many(self, counters):
+		'''
+		Batch version of _create_deletion_handlers.  The watches that are
+		not set yet are set with pipelined async calls through watch_many.
+		Must not be called from the zookeeper event thread.
+
+		:param counters: ids of the nodes to watch
+		:rtype: set of the counters whose node still exists
+		'''
+		with self.lock:
+			watched = set(counter for counter in counters
+				if self.deletion_handlers.get(counter, None) != None)
+		handlers = [
+			Deleted(
+				self.connection, id_to_item_path(self.path, counter),
+				[self._process_deleted], watch=False,
+				session_callbacks=[self._process_session_event])
+			for counter in counters if counter not in watched]
+		for delete_watch in watch_many(handlers):
+			counter = pettingzoo.utils.counter_value(delete_watch.path)
+			with self.lock:
 				# stuff it on the object to make sure the watch still exists
-				self.deletion_handlers[counter] = delete_watch
-		return None
+				if not delete_watch.fired:
+					self.deletion_handlers.setdefault(counter, delete_watch)
+					watched.add(counter)
+		return watched
 
 	def _handle_add(self, counter, candidate):
 		'''
@@ -167,7 +451,7 @@ class LeaderQueue(object):
 		return None
 
 
-	def _update_predecessor_dict(self, counter, candidate):
+	def _update_predecessor_dict(self, counter, candidate, started=None):
 		"""
 		Internal only. finds the predecessor of the candidate.
 		Updates the candidate by predecessor dict adds deletion handlers.
@@ -175,17 +459,18 @@ class LeaderQueue(object):
 		:param counter: (int) counter of candidate you want to update in \
 		  the queue
 		:param candidate: candidate you want to add to predecessor queue 
+		:param started: time.time() at which a predecessor's deletion was \
+		  noticed, if this is a handoff
 		:rtype: None
 		"""
 		try:
-			# loop through children, check existence and counter
-			children = self.connection.children(self.path + PREFIX)
-			pred_id = pettingzoo.utils.min_predecessor(children, counter)
+			pred_id = self._find_predecessor(counter)
 			with self.lock:
 				self.candidate_by_predecessor[pred_id] = candidate
+				self.predecessor_by_candidate[candidate] = pred_id
 			if pred_id == -1:
 				#congrats, you're it.
-				candidate.on_elected()
+				self.dispatcher.submit(self, self._elect, candidate, started)
 			else:
 				#find predecessor and set delete watch on it
 				self._create_deletion_handlers(pred_id)
@@ -196,6 +481,438 @@ class LeaderQueue(object):
 			raise exc_class, exc, tback
 		return None
 
+	def _elect(self, candidate, started):
+		"""
+		Internal only. Runs on the dispatcher. Calls on_elected and reports
+		the handoff latency to the handoff listeners.
+		"""
+		with self.lock:
+			if not self.counter_by_candidate.has_key(candidate):
+				# removed before it could take over
+				return
+			self.leaders = self.leaders | set([candidate])
+		candidate.on_elected()
+		if started == None:
+			return
+		seconds = time.time() - started
+		get_logger().info("LeaderQueue handoff took %.6f seconds" % (seconds))
+		with self.lock:
+			listeners = list(self.handoff_listeners)
+		for listener in listeners:
+			listener(candidate, seconds)
+
+	def _process_session_event(self, node, state):
+		"""
+		Session callback used for Deleted objects.  Every deletion watch
+		reports the same event, so only changes of state are dispatched.
+		When the session expires, the candidates' nodes and watches are gone
+		with it, so every candidate is dropped straight away, before zc.zk
+		watches again on the next session.
+		Not intended for external use.
+		"""
+		with self.lock:
+			if state == zookeeper.EXPIRED_SESSION_STATE:
+				counter = pettingzoo.utils.counter_value(node.path)
+				if self.deletion_handlers.get(counter, None) is not node:
+					# a watch of a session whose candidates were dropped
+					return
+			if state == self.session_state:
+				return
+			self.session_state = state
+			if state == zookeeper.EXPIRED_SESSION_STATE:
+				dropped = self.counter_by_candidate.keys()
+				self.counter_by_candidate = {}
+				self.candidate_by_predecessor = {}
+				self.predecessor_by_candidate = {}
+				handlers = self.deletion_handlers.values()
+				self.deletion_handlers = {}
+				# the session watches again everything it still holds, which
+				# fails for nodes that went with the session
+				for handler in handlers:
+					list(self.connection.watches.pop(handler.key))
+				# the watches of the next session report its states
+				self.session_state = zookeeper.CONNECTED_STATE
+		get_logger().info("LeaderQueue session state %s" % (state))
+		if state == zookeeper.EXPIRED_SESSION_STATE:
+			get_logger().warning(
+				"LeaderQueue lost %s candidates with the session" % (
+					len(dropped)))
+		self.dispatcher.submit(self, self._handle_session_event, state)
+
+	def _handle_session_event(self, state):
+		"""
+		Internal only. Runs on the dispatcher. Revokes every leader when the
+		connection is lost or the session expires, and elects again once the
+		connection is back.
+
+		:param state: zookeeper session state
+		:rtype: None
+		"""
+		if state != zookeeper.CONNECTED_STATE:
+			with self.lock:
+				revoked = self.leaders
+				self.leaders = frozenset()
+			for candidate in revoked:
+				candidate.on_revoked()
+			return
+		with self.lock:
+			enrolled = self.counter_by_candidate.items()
+		for candidate, counter in enrolled:
+			self._update_predecessor_dict(counter, candidate)
+
+class LeaderQueueGroup(object):
+	"""
+	Manages the leader queues of many election paths, such as one per shard,
+	for a single connection.  There is one LeaderQueue, and so one set of
+	watches, per path however often it is asked for.  The queues share one
+	lock and one dispatcher, their paths are created with pipelined calls a
+	level at a time, and add_candidates pipelines candidate creation across
+	every path.
+
+	:param connection: zc.zk.ZooKeeper connection
+	:param dispatcher: (Default pettingzoo.utils.get_dispatcher()) runs \
+	  on_elected for every queue
+	"""
+	def __init__(self, connection, dispatcher=None):
+		self.connection = connection
+		self.dispatcher = dispatcher or pettingzoo.utils.get_dispatcher()
+		self.lock = threading.Lock()
+		self.queues = {}
+		self.handoff_listeners = []
+		# znodes known to exist, so they are not created again
+		self.created = set()
+
+	def get_queue(self, path):
+		"""
+		Returns the LeaderQueue for path, creating it if needed.
+
+		:param path: election path
+		:rtype: LeaderQueue
+		"""
+		return self.add_queues([path])[0]
+
+	def add_queues(self, paths):
+		"""
+		Returns the LeaderQueues for many paths, creating the missing ones.
+
+		:param paths: iterable of election paths
+		:rtype: *list* of LeaderQueue, in the order of paths
+		"""
+		paths = list(paths)
+		with self.lock:
+			missing = [path for path in paths if path not in self.queues]
+		if missing:
+			self._create_paths([path + PREFIX for path in missing])
+		for path in missing:
+			# built outside the lock, as it registers a children watch
+			queue = LeaderQueue(
+				self.connection, path, self.dispatcher, self.lock,
+				create_path=False)
+			with self.lock:
+				if path in self.queues:
+					continue
+				self.queues[path] = queue
+				# the queue shares the lock, which is already held
+				queue.handoff_listeners.extend(self.handoff_listeners)
+		with self.lock:
+			return [self.queues[path] for path in paths]
+
+	def add_candidates(self, candidates_by_path, meta_data=None):
+		"""
+		Adds candidates to many queues at once.  Every node is created with
+		a pipelined async call before any reply is waited for.
+
+		:param candidates_by_path: dict of election path to a list of \
+		  candidates
+		:param meta_data: binary data to store on every node
+		:rtype: dict of election path to the list of pettingzoo.utils.Future \
+		  returned by LeaderQueue.add_candidates
+		"""
+		paths = list(candidates_by_path)
+		queues = self.add_queues(paths)
+		futures = {}
+		for path, queue in zip(paths, queues):
+			futures[path] = queue.add_candidates(
+				candidates_by_path[path], meta_data)
+		return futures
+
+	def remove_candidate(self, path, candidate):
+		"""
+		Removes candidate from the queue of path.
+
+		:param path: election path
+		:param candidate: candidate to remove
+		:rtype: True if successful, False otherwise
+		"""
+		with self.lock:
+			queue = self.queues.get(path, None)
+		if queue == None:
+			return False
+		return queue.remove_candidate(candidate)
+
+	def is_leader(self, path, candidate):
+		"""
+		Checks whether candidate leads path.  See LeaderQueue.is_leader.
+
+		:param path: election path
+		:param candidate: candidate to check
+		:rtype: True if candidate is elected and connected, False otherwise
+		"""
+		queue = self.queues.get(path, None)
+		return queue != None and queue.is_leader(candidate)
+
+	def add_handoff_listener(self, callback):
+		"""
+		Adds a handoff listener to every queue, including queues added later.
+		See LeaderQueue.add_handoff_listener.
+
+		:param callback: function taking (candidate, seconds)
+		:rtype: None
+		"""
+		with self.lock:
+			self.handoff_listeners.append(callback)
+			queues = self.queues.values()
+		for queue in queues:
+			queue.add_handoff_listener(callback)
+
+	def _create_paths(self, paths):
+		"""
+		Internal only. Creates paths and their parents, one level at a time,
+		with the creates of each level pipelined.
+
+		:param paths: znode paths to create
+		:rtype: None
+		"""
+		levels = {}
+		with self.lock:
+			for path in paths:
+				parts = path.split('/')
+				for depth in range(2, len(parts) + 1):
+					node = '/'.join(parts[:depth])
+					if node not in self.created:
+						levels.setdefault(depth, set()).add(node)
+		for depth in sorted(levels):
+			nodes = sorted(levels[depth])
+			results = pettingzoo.utils.run_many([
+				(self.connection.acreate,
+					(node, "", zc.zk.OPEN_ACL_UNSAFE, 0))
+				for node in nodes])
+			for node, (status, args) in zip(nodes, results):
+				if status not in (zookeeper.OK, zookeeper.NODEEXISTS):
+					raise Exception("LeaderQueueGroup could not create %s: %s" % (
+						node, zookeeper.zerror(status)))
+			with self.lock:
+				self.created.update(nodes)
+		get_logger().debug(
+			"LeaderQueueGroup created %s nodes in %s levels" % (
+				sum(len(nodes) for nodes in levels.values()), len(levels)))
+
+class BalancedLeaderQueueGroup(LeaderQueueGroup):
+	"""
+	A LeaderQueueGroup that spreads leadership evenly across the processes
+	contesting its paths.  Every process is expected to enrol one candidate
+	in each path, so the number of candidates in a queue is the number of
+	processes.  Whenever a queue changes or a candidate is elected, a
+	process leading more than its share of the paths steps back from the
+	excess: its candidate is removed, which elects the next in line, and
+	enrolled again at the back of the queue.
+
+	:param connection: zc.zk.ZooKeeper connection
+	:param dispatcher: (Default pettingzoo.utils.get_dispatcher()) runs \
+	  on_elected, on_revoked and rebalancing
+	:param slack: (Default 0) paths a process may lead beyond its share \
+	  before stepping back
+
+	**Note**
+
+	Candidates are enrolled wrapped in a _BalancedCandidate, which is what
+	handoff listeners and the LeaderQueues see.
+	"""
+	def __init__(self, connection, dispatcher=None, slack=0):
+		super(BalancedLeaderQueueGroup, self).__init__(connection, dispatcher)
+		self.slack = slack
+		# path to the _BalancedCandidate enrolled there
+		self.contested = {}
+		self.leading = set()
+		self.rebalance_pending = False
+
+	def add_queues(self, paths):
+		"""
+		See LeaderQueueGroup.add_queues.  New queues also trigger a
+		rebalance whenever their candidates change.
+		"""
+		paths = list(paths)
+		with self.lock:
+			missing = [path for path in paths if path not in self.queues]
+		queues = super(BalancedLeaderQueueGroup, self).add_queues(paths)
+		for path, queue in zip(paths, queues):
+			if path in missing:
+				queue.children(self._schedule_rebalance)
+		return queues
+
+	def add_candidates(self, candidates_by_path, meta_data=None):
+		"""
+		See LeaderQueueGroup.add_candidates.  Only one candidate may be
+		enrolled in each path.
+		"""
+		wrapped = {}
+		with self.lock:
+			for path, candidates in candidates_by_path.items():
+				if len(candidates) > 1 or path in self.contested:
+					raise Exception(
+						"BalancedLeaderQueueGroup takes one candidate per path")
+				wrapped[path] = [
+					_BalancedCandidate(self, path, candidate, meta_data)
+					for candidate in candidates]
+				if wrapped[path]:
+					self.contested[path] = wrapped[path][0]
+		return super(BalancedLeaderQueueGroup, self).add_candidates(
+			wrapped, meta_data)
+
+	def remove_candidate(self, path, candidate):
+		"""
+		See LeaderQueueGroup.remove_candidate.
+		"""
+		with self.lock:
+			wrapper = self.contested.get(path, None)
+			if wrapper == None or wrapper.candidate is not candidate:
+				return False
+			del self.contested[path]
+			self.leading.discard(path)
+		return super(BalancedLeaderQueueGroup, self).remove_candidate(
+			path, wrapper)
+
+	def is_leader(self, path, candidate):
+		"""
+		See LeaderQueueGroup.is_leader.
+		"""
+		wrapper = self.contested.get(path, None)
+		return (wrapper != None and wrapper.candidate is candidate
+			and super(BalancedLeaderQueueGroup, self).is_leader(path, wrapper))
+
+	def get_leading(self):
+		"""
+		Returns the paths this process leads.
+
+		:rtype: frozenset of election paths
+		"""
+		with self.lock:
+			return frozenset(self.leading)
+
+	def rebalance(self):
+		"""
+		Steps back from the paths this process leads beyond its share.  The
+		share is the number of contested paths divided by the most candidates
+		seen in any queue, rounded up, plus slack.  Paths with no other
+		candidate are kept.
+
+		:rtype: *int* number of paths stepped back from
+		"""
+		with self.lock:
+			self.rebalance_pending = False
+			processes = max([len(queue.counters)
+				for queue in self.queues.values()] or [1])
+			share = -(-len(self.contested) // max(processes, 1)) + self.slack
+			excess = len(self.leading) - share
+			if excess <= 0:
+				return 0
+			shared = [path for path in self.leading
+				if len(self.queues[path].counters) > 1]
+			paths = random.sample(shared, min(excess, len(shared)))
+		for path in paths:
+			self._step_back(path)
+		get_logger().info(
+			"BalancedLeaderQueueGroup stepped back from %s paths, share %s" % (
+				len(paths), share))
+		return len(paths)
+
+	def _step_back(self, path):
+		"""
+		Internal only. Hands leadership of path to the next candidate and
+		enrols this process's candidate again.
+		"""
+		with self.lock:
+			wrapper = self.contested.get(path, None)
+			if wrapper == None or path not in self.leading:
+				return
+			self.leading.discard(path)
+		# keyed like on_elected, so the two run in order
+		self.dispatcher.submit(self.queues[path], self._hand_off, wrapper)
+
+	def _hand_off(self, wrapper):
+		"""
+		Internal only. Runs on the dispatcher. Calls on_revoked and only then
+		removes the candidate, which elects the next in line, so that two
+		processes never lead the path at once.  The candidate is then
+		enrolled again at the back of the queue.
+		"""
+		with self.lock:
+			if self.contested.get(wrapper.path, None) is not wrapper:
+				return
+		queue = self.queues[wrapper.path]
+		try:
+			wrapper.candidate.on_revoked()
+		finally:
+			queue.remove_candidate(wrapper)
+		with self.lock:
+			if self.contested.get(wrapper.path, None) is not wrapper:
+				return
+		queue.add_candidate(wrapper, wrapper.meta_data)
+
+	def _on_elected(self, wrapper):
+		"""
+		Internal only. Called on the dispatcher when a wrapped candidate is
+		elected.
+		"""
+		with self.lock:
+			if self.contested.get(wrapper.path, None) is not wrapper:
+				return
+			self.leading.add(wrapper.path)
+		wrapper.candidate.on_elected()
+		self._schedule_rebalance()
+
+	def _on_revoked(self, wrapper):
+		"""
+		Internal only. Called on the dispatcher when a wrapped candidate
+		loses leadership with its connection.
+		"""
+		with self.lock:
+			if (self.contested.get(wrapper.path, None) is not wrapper
+					or wrapper.path not in self.leading):
+				# stepped back, and _hand_off calls on_revoked
+				return
+			self.leading.discard(wrapper.path)
+		wrapper.candidate.on_revoked()
+
+	def _schedule_rebalance(self, children=None):
+		"""
+		Internal only. Queues one rebalance on the dispatcher, however many
+		changes ask for it before it runs.  Also the children callback of
+		every queue.
+		"""
+		with self.lock:
+			if self.rebalance_pending:
+				return
+			self.rebalance_pending = True
+		self.dispatcher.submit(self, self.rebalance)
+
+class _BalancedCandidate(object):
+	"""
+	Internal only. The candidate a BalancedLeaderQueueGroup enrols on behalf
+	of a user candidate.
+	"""
+	def __init__(self, group, path, candidate, meta_data):
+		self.group = group
+		self.path = path
+		self.candidate = candidate
+		self.meta_data = meta_data
+
+	def on_elected(self):
+		self.group._on_elected(self)
+
+	def on_revoked(self):
+		self.group._on_revoked(self)
+
 class Candidate:
 	__metaclass__ = ABCMeta
 
@@ -206,6 +923,14 @@ class Candidate:
 		once a candidate has been elected leader
 		'''
 
+	def on_revoked(self):
+		'''
+		called when a candidate that was elected leader stops being leader
+		without being removed by its owner, such as when the connection is
+		lost or a BalancedLeaderQueueGroup steps back.  Does nothing by
+		default.
+		'''
+
 def id_to_item_path(path, item_id):
 	"""
 	Returns the full znode path for a given item id.
@@ -5,6 +5,28 @@ Classes and functions that implement the config paradigm for PettingZoo.
 import yaml
 import os
 
+# LibYAML's C parser and emitter are several times faster then the pure python
+# ones, but are only available if PyYAML was built against LibYAML.  Both the
+# C and python versions are the safe variants, which refuse arbitrary python
+# tags.
+try:
+	from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+	from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
+
+def load_yaml(stream):
+	"""
+	Parses a yaml document from a string or file, using LibYAML when available.
+	"""
+	return yaml.load(stream, Loader=YamlLoader)
+
+def dump_yaml(data, stream=None, **kwargs):
+	"""
+	Serialises data as yaml, using LibYAML when available.  Takes the same
+	keyword arguments as yaml.dump.
+	"""
+	return yaml.dump(data, stream, Dumper=YamlDumper, **kwargs)
+
 class LocalConfigPathDefaults(object):
 	"""
 	This class is a singleton intended to hold the paths that will be looked at,
@@ -59,7 +81,8 @@ def fetch_local_config(default, config=None):
 	retcfg = default
 	if config:
 		retcfg = config
-	return yaml.load(file(find_local_config_path(retcfg)))
+	with open(find_local_config_path(retcfg)) as config_file:
+		return load_yaml(config_file)
 
 class LocalConfigDefault(object):
 	"""
@@ -1,8 +1,15 @@
 import zookeeper
+import itertools
+import threading
+import time
 from zc.zk.testing import Node, badpath
 import zc.zk.testing
 
 TESTING_FLAG = 32
+# name zc.thread gives the threads running the mock's async calls
+ASYNC_THREAD = 'zc.zk.testing.doasync'
+_node_meta = Node.meta
+_zxids = itertools.count(1)
 def create(self, handle, path, data, acl, flags=0):
 	with self.lock:
 		self._check_handle(handle)
@@ -40,11 +47,23 @@ def exists(self, handle, path, watch=None):
 			node.watchers += ((handle, watch), )
 		self._check_handle(handle)
 		try:
-			self._traverse(path)
-			return True
+			return _stat(self._traverse(path))
 		except zookeeper.NoNodeException:
 			return False
 
+def _stat(node):
+	"""
+	Returns the stat of node like zookeeper.exists does.  Nodes created with
+	None as data are reported with a dataLength of 0.
+	"""
+	if node.data is not None:
+		return node.meta()
+	node.data = ''
+	try:
+		return node.meta()
+	finally:
+		node.data = None
+
 def deleted(self, handle, state, path):
 	watchers = self.watchers
 	self.watchers = ()
@@ -55,3 +74,45 @@ def deleted(self, handle, state, path):
 	for h, w in watchers:
 		w(h, zookeeper.DELETED_EVENT | TESTING_FLAG, state, path)
 
+
+def expire(self):
+	"""
+	Expires the session like zc.zk.testing does, but delivers the expiry to
+	the watches set on the session first, as the zookeeper client does.  The
+	mock delivers it after zc.zk has opened the next session, which reuses
+	the handle, so the watches of the next session would get it instead.
+	"""
+	self.zk._session_event(self.handle, zookeeper.EXPIRED_SESSION_STATE)
+	self.zk._clear_session(self)
+	self.state = zookeeper.EXPIRED_SESSION_STATE
+	if self.watch is not None:
+		self.watch(self.handle, zookeeper.SESSION_EVENT, self.state, '')
+
+def meta(self):
+	"""
+	Adds czxid and mzxid to the stat of the mock zookeeper, taking a new
+	zxid whenever a node is created or its data changes.
+	"""
+	stat = _node_meta(self)
+	if getattr(self, 'mzxid_version', None) != self.version:
+		self.mzxid = _zxids.next()
+		if not hasattr(self, 'czxid'):
+			self.czxid = self.mzxid
+		self.mzxid_version = self.version
+	stat['czxid'] = self.czxid
+	stat['mzxid'] = self.mzxid
+	return stat
+
+def join_async(timeout=1.0):
+	"""
+	Waits for the async calls of the mock zookeeper, which run on threads of
+	their own, to complete.  Returns False if some were still running after
+	timeout seconds.
+	"""
+	deadline = time.time() + timeout
+	for thread in threading.enumerate():
+		if thread.name == ASYNC_THREAD:
+			thread.join(max(deadline - time.time(), 0))
+			if thread.is_alive():
+				return False
+	return True
@@ -1,5 +1,7 @@
 import unittest
 import threading
+import time
+import zookeeper
 from pettingzoo.dbag import *
 from pettingzoo.utils import connect_to_zk, configure_logger
 
@@ -19,6 +21,17 @@ class DbagTests(unittest.TestCase):
 		self.touched = False
 		configure_logger()
 
+	def wait_for(self, condition, timeout=1.0):
+		"""Polls condition until it holds, as token writes are asynchronous."""
+		deadline = time.time() + timeout
+		while not condition() and time.time() < deadline:
+			time.sleep(0.01)
+
+	def tokens(self):
+		"""Returns the token children of the test bag."""
+		return [
+			child for child in self.connection.children(self.path + "/token")]
+
 	def test_dbag_create(self):
 		"""Tests that instantiating dbag creates all the needed paths."""
 		DistributedBag(self.connection, self.path)
@@ -38,8 +51,8 @@ class DbagTests(unittest.TestCase):
 		self.assertTrue('item0000000000' in children)
 		self.assertTrue('item0000000001' in children)
 		self.assertEquals(len(children), 2)
-		children = [
-			child for child in self.connection.children(self.path + "/token")]
+		self.wait_for(lambda: self.tokens() == ['token0000000001'])
+		children = self.tokens()
 		self.assertTrue('token0000000001' in children)
 		self.assertEquals(len(children), 1)
 
@@ -60,11 +73,76 @@ class DbagTests(unittest.TestCase):
 			child for child in self.connection.children(self.path + "/item")]
 		self.assertTrue('item0000000000' in children)
 		self.assertFalse('item0000000001' in children)
-		children = [
-			child for child in self.connection.children(self.path + "/token")]
+		self.wait_for(lambda: self.tokens() == ['token0000000001'])
+		children = self.tokens()
 		self.assertTrue('token0000000001' in children)
 		self.assertEquals(len(children), 1)
 
+	def test_dbag_add_remove_many(self):
+		"""
+		Tests that add_many and remove_many change every item, and that
+		add_many leaves a single token for the highest id.
+		"""
+		dbag = DistributedBag(self.connection, self.path)
+		dbag.add("foo", False)
+		item_ids = dbag.add_many(["bar", "baz", "qux"], False)
+		# The mock runs each async call on its own thread, so ids can come
+		# back out of order
+		self.assertEqual(sorted(item_ids), [1, 2, 3])
+		self.wait_for(lambda: self.tokens() == ['token0000000003'])
+		self.assertEqual(self.tokens(), ['token0000000003'])
+		self.wait_for(lambda: dbag.get_items() == set([0, 1, 2, 3]))
+		self.assertEqual(dbag.get_items(), set([0, 1, 2, 3]))
+		self.assertEqual(dbag.get_many(item_ids),
+			dict(zip(item_ids, ["bar", "baz", "qux"])))
+		self.assertEqual(dbag.remove_many([0, 2, 5]), [True, True, False])
+		self.wait_for(lambda: dbag.get_items() == set([1, 3]))
+		self.assertEqual(dbag.get_items(), set([1, 3]))
+
+	def test_dbag_add_many_failure(self):
+		"""
+		Tests that add_many removes the items it created when another create
+		fails, and that the ids it returns follow the order of payloads.
+		"""
+		class FailingCreates(object):
+			def __init__(self, connection):
+				self.connection = connection
+			def __getattr__(self, name):
+				return getattr(self.connection, name)
+			def acreate(self, path, data, acl, flags, completion):
+				if data == "fail":
+					completion(0, zookeeper.NOAUTH)
+				else:
+					self.connection.acreate(path, data, acl, flags, completion)
+		dbag = DistributedBag(self.connection, self.path)
+		payloads = ["item%s" % index for index in range(10)]
+		item_ids = dbag.add_many(payloads, False)
+		self.assertEqual(
+			[dbag.connection.get(id_to_item_path(self.path, item_id))[0]
+				for item_id in item_ids], payloads)
+		dbag.connection = FailingCreates(self.connection)
+		self.assertRaises(
+			Exception, dbag.add_many, ["foo", "fail", "bar"], False)
+		self.assertEqual(len(self.connection.children(self.path + "/item")), 10)
+
+	def test_dbag_token_sweeper(self):
+		"""
+		Tests that only the bag that wrote the highest token sweeps the stale
+		ones, so each is deleted once however many bags share the path.
+		"""
+		bags = [DistributedBag(self.connection, self.path) for _ in range(3)]
+		deletes = zookeeper.adelete.call_count
+		for dbag in bags:
+			item_id = dbag.add("foo", False)
+			# wait for the sweep, as the next writer may also delete a token
+			# whose delete is still in flight
+			self.wait_for(lambda: self.tokens() == [
+				id_to_token_path(self.path, item_id).rsplit("/", 1)[1]])
+		self.wait_for(lambda: all(
+			dbag.get_items() == set([0, 1, 2]) for dbag in bags))
+		self.assertEqual(self.tokens(), ['token0000000002'])
+		self.assertEqual(zookeeper.adelete.call_count - deletes, 2)
+
 	def test_dbag_get(self):
 		"""
 		Tests that calling get returns you the data payload of the item you
@@ -77,6 +155,55 @@ class DbagTests(unittest.TestCase):
 		result = dbag.get(1)
 		self.assertEqual(result, None)
 
+	def test_dbag_get_many(self):
+		"""
+		Tests that get_many returns the payloads of existing items, caches
+		them, and evicts them when the item is removed.
+		"""
+		dbag = DistributedBag(self.connection, self.path)
+		event = threading.Event()
+		dbag.add_listeners(remove_callback=lambda x, y: event.set())
+		dbag.add("foo", False)
+		dbag.add("bar", False)
+		self.assertEqual(dbag.get_many([0, 1, 2]), {0: "foo", 1: "bar"})
+		self.assertEqual(dbag.payloads, {0: "foo", 1: "bar"})
+		self.assertEqual(dbag.get(1), "bar")
+		dbag.remove(0)
+		event.wait(0.25)
+		self.assertEqual(dbag.payloads, {1: "bar"})
+		self.assertEqual(dbag.get_many([0, 1]), {1: "bar"})
+
+	def test_dbag_get_cached_shares_lock(self):
+		"""
+		Tests that cached lookups only take the read lock, so they do not
+		wait for other readers.
+		"""
+		dbag = DistributedBag(self.connection, self.path)
+		dbag.add("foo", False)
+		self.assertEqual(dbag.get_many([0]), {0: "foo"})
+		results = []
+		reader = threading.Thread(
+			target=lambda: results.append((dbag.get(0), dbag.get_many([0]))))
+		dbag.lock.acquire_read()
+		try:
+			reader.start()
+			reader.join(1.0)
+			finished = not reader.is_alive()
+		finally:
+			dbag.lock.release_read()
+		reader.join()
+		self.assertTrue(finished)
+		self.assertEqual(results, [("foo", {0: "foo"})])
+
+	def test_dbag_prefetch(self):
+		"""Tests that a prefetching bag caches payloads as items are added."""
+		writer = DistributedBag(self.connection, self.path)
+		writer.add("foo", False)
+		dbag = DistributedBag(self.connection, self.path, prefetch=True)
+		writer.add("bar", False)
+		self.wait_for(lambda: len(dbag.payloads) == 2)
+		self.assertEqual(dbag.payloads, {0: "foo", 1: "bar"})
+
 	def test_dbag_get_items(self):
 		"""Tests that calling get_items returns you all item ids."""
 		dbag = DistributedBag(self.connection, self.path)
@@ -85,6 +212,7 @@ class DbagTests(unittest.TestCase):
 		dbag.add_listeners(remove_callback=lambda x, y: event.set())
 		dbag.add("bar", False)
 		event.wait(0.25)
+		self.wait_for(lambda: dbag.get_items() == set([0, 1]))
 		self.assertEqual(dbag.get_items(), set([0, 1]))
 
 	def test_dbag_get_items_with_remove(self):
@@ -98,6 +226,7 @@ class DbagTests(unittest.TestCase):
 		dbag.add_listeners(add_callback=lambda x, y: event.set())
 		dbag.add("baz", False)
 		event.wait(0.25)
+		self.wait_for(lambda: dbag.get_items() == set([0, 1, 2]))
 		self.assertEqual(dbag.get_items(), set([0, 1, 2]))
 		event.clear()
 		dbag.add_listeners(remove_callback=lambda x, y: event.set())
@@ -108,11 +237,65 @@ class DbagTests(unittest.TestCase):
 		self.assertTrue('item0000000000' in children)
 		self.assertFalse('item0000000001' in children)
 		self.assertTrue('item0000000002' in children)
-		children = [
-			child for child in self.connection.children(self.path + "/token")]
+		self.wait_for(lambda: self.tokens() == ['token0000000002'])
+		children = self.tokens()
 		self.assertTrue('token0000000002' in children)
+		self.wait_for(lambda: dbag.get_items() == set([0, 2]))
 		self.assertEqual(dbag.get_items(), set([0, 2]))
 		
+	def test_dbag_lazy_snapshot(self):
+		"""
+		Tests that changes only bump the version, and the snapshot is built
+		by the first read after them.
+		"""
+		dbag = DistributedBag(self.connection, self.path)
+		dbag.add("foo", False)
+		dbag.add("bar", False)
+		self.wait_for(lambda: len(dbag.ids) == 2)
+		self.assertEqual(dbag.snapshot, (0, frozenset()))
+		items = dbag.get_items()
+		self.assertEqual(items, frozenset([0, 1]))
+		self.assertEqual(dbag.snapshot, (dbag.version, items))
+		self.assertTrue(dbag.get_items() is items)
+
+	def test_dbag_get_items_since(self):
+		"""
+		Tests that get_items returns the same snapshot until the bag changes,
+		and that get_items_since returns only the changes after a version.
+		"""
+		dbag = DistributedBag(self.connection, self.path)
+		dbag.add("foo", False)
+		self.wait_for(lambda: dbag.get_items() == set([0]))
+		self.assertTrue(dbag.get_items() is dbag.get_items())
+		version, items = dbag.get_snapshot()
+		self.assertEqual(items, frozenset([0]))
+		self.assertEqual(
+			dbag.get_items_since(version), (version, frozenset(), frozenset()))
+		dbag.add("bar", False)
+		dbag.add("baz", False)
+		dbag.remove(1)
+		dbag.remove(0)
+		self.wait_for(lambda: dbag.get_items() == set([2]))
+		current, added, removed = dbag.get_items_since(version)
+		self.assertEqual(current, dbag.get_snapshot()[0])
+		self.assertEqual(added, frozenset([2]))
+		self.assertEqual(removed, frozenset([0]))
+		dbag.changes.popleft()
+		self.assertEqual(
+			dbag.get_items_since(0), (current, frozenset([2]), None))
+
+	def test_dbag_new_id_already_deleted(self):
+		"""
+		Tests that an id learned after its item was deleted is neither added
+		nor removed, and that its deletion watch is not kept.
+		"""
+		dbag = DistributedBag(self.connection, self.path)
+		dbag._process_children_changed(['token0000000000'])
+		self.assertEqual(dbag.get_items(), frozenset())
+		self.assertEqual(
+			dbag.get_items_since(0), (0, frozenset(), frozenset()))
+		self.assertEqual(dbag.deletion_handlers, {})
+
 	def test_dbag_add_listeners_add(self):
 		"""
 		tests that adding items causes them to be properly added to the list.
@@ -131,6 +314,7 @@ class DbagTests(unittest.TestCase):
 		event.clear()
 		dbag.add("bar", False)
 		event.wait(0.25)
+		self.wait_for(lambda: dbag.get_items() == set([0, 1]))
 		self.assertEqual(dbag.get_items(), set([0, 1]))
 		self.assertTrue(self.touched)
 
@@ -146,6 +330,7 @@ class DbagTests(unittest.TestCase):
 		dbag.add_listeners(add_callback=lambda x, y: event.set())
 		dbag.add("baz", False)
 		event.wait(0.25)
+		self.wait_for(lambda: dbag.get_items() == set([0, 1, 2]))
 		self.assertEqual(dbag.get_items(), set([0, 1, 2]))
 		event.clear()
 		def callback(idbag, bag_id):
@@ -161,13 +346,107 @@ class DbagTests(unittest.TestCase):
 		self.assertTrue('item0000000000' in children)
 		self.assertFalse('item0000000001' in children)
 		self.assertTrue('item0000000002' in children)
-		children = [
-			child for child in self.connection.children(self.path + "/token")]
+		self.wait_for(lambda: self.tokens() == ['token0000000002'])
+		children = self.tokens()
 		self.assertTrue('token0000000002' in children)
 		event.wait(0.25)
+		self.wait_for(lambda: dbag.get_items() == set([0, 2]))
 		self.assertEqual(dbag.get_items(), set([0, 2]))
 		self.assertTrue(self.touched)
 
+	def test_dbag_batch_listener(self):
+		"""
+		Tests that batch listeners get every id changed by an event in one
+		call, and that a window coalesces several events.
+		"""
+		dbag = DistributedBag(self.connection, self.path)
+		dbag.add("foo", False)
+		self.wait_for(lambda: dbag.get_items() == set([0]))
+		batches = []
+		windowed = []
+		self.assertEqual(dbag.add_batch_listener(
+			lambda x, added, removed: batches.append((added, removed))),
+			set([0]))
+		dbag.add_batch_listener(
+			lambda x, added, removed: windowed.append((added, removed)), 0.25)
+		dbag.add_many(["bar", "baz"], False)
+		self.wait_for(lambda: len(batches) == 1)
+		self.assertEqual(batches, [(frozenset([1, 2]), frozenset())])
+		dbag.remove(0)
+		dbag.remove(1)
+		self.wait_for(lambda: len(batches) == 3)
+		self.assertEqual(batches[1:], [
+			(frozenset(), frozenset([0])), (frozenset(), frozenset([1]))])
+		self.wait_for(lambda: windowed)
+		self.assertEqual(windowed, [(frozenset([2]), frozenset([0]))])
+
+	def test_dbag_batch_listener_deleted_id(self):
+		"""
+		Tests that listeners are not told of an id learned after its item was
+		deleted.
+		"""
+		dbag = DistributedBag(self.connection, self.path)
+		changes = []
+		dbag.add_batch_listener(
+			lambda x, added, removed: changes.append((added, removed)))
+		dbag.add_listeners(
+			add_callback=lambda x, bag_id: changes.append(('add', bag_id)),
+			remove_callback=lambda x, bag_id: changes.append(
+				('remove', bag_id)))
+		dbag._process_children_changed(['token0000000000'])
+		self.assertTrue(dbag.dispatcher.join(1.0))
+		self.assertEqual(changes, [])
+
+	def test_dbag_populate(self):
+		"""
+		Tests that joining a bag with existing items watches every item, so
+		later removals are still seen.
+		"""
+		writer = DistributedBag(self.connection, self.path)
+		for i in range(5):
+			writer.add("foo%s" % i, False)
+		writer.remove(3)
+		dbag = DistributedBag(self.connection, self.path)
+		self.wait_for(lambda: dbag.get_items() == set([0, 1, 2, 4]))
+		self.assertEqual(dbag.get_items(), set([0, 1, 2, 4]))
+		self.assertEqual(
+			sorted(dbag.deletion_handlers.keys()), [0, 1, 2, 4])
+		event = threading.Event()
+		dbag.add_listeners(remove_callback=lambda x, y: event.set())
+		writer.remove(1)
+		event.wait(0.25)
+		self.wait_for(lambda: dbag.get_items() == set([0, 2, 4]))
+		self.assertEqual(dbag.get_items(), set([0, 2, 4]))
+		self.assertFalse(1 in dbag.deletion_handlers)
+
+	def test_dbag_track_children(self):
+		"""
+		Tests that a bag tracking the item children sees items added and
+		removed by another bag on the same path, without setting per item
+		watches.
+		"""
+		writer = DistributedBag(self.connection, self.path)
+		writer.add("foo", False)
+		dbag = DistributedBag(self.connection, self.path, TRACK_CHILDREN)
+		self.wait_for(lambda: dbag.get_items() == set([0]))
+		self.assertEqual(dbag.get_items(), set([0]))
+		added = []
+		removed = []
+		dbag.add_listeners(
+			add_callback=lambda x, y: added.append(y),
+			remove_callback=lambda x, y: removed.append(y))
+		writer.add("bar", False)
+		writer.add("baz", False)
+		writer.remove(0)
+		self.wait_for(lambda: dbag.get_items() == set([1, 2]))
+		self.assertEqual(dbag.get_items(), set([1, 2]))
+		self.wait_for(lambda: len(added) == 2 and removed)
+		self.assertEqual(added, [1, 2])
+		self.assertEqual(removed, [0])
+		self.assertEqual(dbag.deletion_handlers, {})
+		self.assertRaises(
+			Exception, DistributedBag, self.connection, self.path, "bogus")
+
 	def test_max_counter(self):
 		"""
 		Tests that pettingzoo.utils.max_counter properly returns the integer
@@ -184,6 +463,91 @@ class DbagTests(unittest.TestCase):
 		result = pettingzoo.utils.counter_path("aasfgsfgsdfgsdfg-", 1001)
 		self.assertEquals(result, "aasfgsfgsdfgsdfg-0000001001")
 
+	def test_lru_cache(self):
+		"""
+		Tests that pettingzoo.utils.LRUCache evicts the least recently used
+		entry once full.
+		"""
+		cache = pettingzoo.utils.LRUCache(2)
+		cache.put('a', 1)
+		cache.put('b', 2)
+		self.assertEquals(cache.get('a'), 1)
+		cache.put('c', 3)
+		self.assertFalse('b' in cache)
+		self.assertEquals(cache.get('a'), 1)
+		self.assertEquals(cache.get('c'), 3)
+		self.assertEquals(len(cache), 2)
+
+	def test_fair_read_write_lock(self):
+		"""
+		Tests that pettingzoo.utils.FairReadWriteLock makes new readers wait
+		behind a waiting writer, and lets the writer reenter and read.
+		"""
+		lock = pettingzoo.utils.FairReadWriteLock()
+		order = []
+		lock.acquire_read()
+		def writer():
+			with lock:
+				with lock:
+					lock.acquire_read()
+					order.append('writer')
+					lock.release_read()
+		def reader():
+			lock.acquire_read()
+			order.append('reader')
+			lock.release_read()
+		write_thread = threading.Thread(target=writer)
+		write_thread.start()
+		self.wait_for(lambda: lock._waiting_writers)
+		read_thread = threading.Thread(target=reader)
+		read_thread.start()
+		self.wait_for(lambda: lock._waiting_readers)
+		self.assertEqual(order, [])
+		lock.release_read()
+		write_thread.join(1)
+		read_thread.join(1)
+		self.assertEqual(order, ['writer', 'reader'])
+
+	def test_dispatcher(self):
+		"""
+		Tests that pettingzoo.utils.Dispatcher runs callbacks with the same key
+		in order, lets other keys run while one is blocked, and counts them.
+		"""
+		dispatcher = pettingzoo.utils.Dispatcher(workers=2)
+		release = threading.Event()
+		done = threading.Event()
+		order = []
+		dispatcher.submit('slow', release.wait, 1)
+		for index in range(5):
+			dispatcher.submit('slow', order.append, index)
+		dispatcher.submit('fast', done.set)
+		self.assertTrue(done.wait(1))
+		self.assertEqual(order, [])
+		release.set()
+		self.wait_for(lambda: len(order) == 5)
+		self.assertEqual(order, range(5))
+		self.wait_for(lambda: dispatcher.stats()['completed'] == 7)
+		stats = dispatcher.stats()
+		self.assertEqual(stats['pending'], 0)
+		self.assertEqual(stats['submitted'], 7)
+		self.assertTrue(stats['max_pending'] >= 5)
+
+	def test_dispatcher_join(self):
+		"""
+		Tests that Dispatcher.join waits for queued callbacks, and times out
+		while one is blocked.
+		"""
+		dispatcher = pettingzoo.utils.Dispatcher(workers=1)
+		release = threading.Event()
+		order = []
+		dispatcher.submit('slow', release.wait, 1)
+		dispatcher.submit('slow', order.append, 1)
+		self.assertFalse(dispatcher.join(0.05))
+		release.set()
+		self.assertTrue(dispatcher.join(1))
+		self.assertEqual(order, [1])
+		self.assertEqual(dispatcher.stats()['completed'], 2)
+
 	def test_id_to_item_path(self):
 		""" Tests that id_to_item_path returns an appropriate item path."""
 		self.assertEquals(
@@ -196,7 +560,24 @@ class DbagTests(unittest.TestCase):
 			id_to_token_path('/foo', 1354),
 			'/foo/token/token0000001354')
 
+	def drain(self, timeout=1.0):
+		"""
+		Waits for async token writes and dispatched callbacks to finish.  They
+		can set off each other, so this waits until both are idle at once.
+		"""
+		import pettingzoo.testing
+		dispatcher = pettingzoo.utils.get_dispatcher()
+		deadline = time.time() + timeout
+		while time.time() < deadline:
+			if pettingzoo.testing.join_async(max(deadline - time.time(), 0)) \
+					and dispatcher.join(max(deadline - time.time(), 0)) \
+					and pettingzoo.testing.join_async(0):
+				return
+		self.fail("bag did not settle within %s seconds" % (timeout))
+
 	def tearDown(self):
+		if self.mock:
+			self.drain()
 		self.connection.close()
 		self.connection = connect_to_zk('127.0.0.1:2181')
 		try:
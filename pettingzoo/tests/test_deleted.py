@@ -33,6 +33,17 @@ class DeletedTests(unittest.TestCase):
 		self.connection.delete_recursive(test_path)
 		self.assertTrue(self.touched)
 
+	def test_deleted_watch_missing_node(self):
+		"""
+		Tests that watching a node that is already gone fires the callbacks.
+		"""
+		self.touched = False
+		def cb(e):
+			self.touched = True
+		deleted = Deleted(self.connection, self.path + "/missing", [cb])
+		self.assertTrue(self.touched)
+		self.assertTrue(deleted.fired)
+
 	def test_shared_connection(self):
 		if not DO_MOCK:
 			DistributedBag(
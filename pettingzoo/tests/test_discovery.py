@@ -1,8 +1,12 @@
+import copy
+import time
 import unittest
 import yaml
+import zookeeper
 import threading
 import pettingzoo.local_config
 import pettingzoo.discovery
+import zc.zk.testing
 from pettingzoo.utils import connect_to_zk
 
 class DiscoveryTests(unittest.TestCase):
@@ -48,6 +52,83 @@ class DiscoveryTests(unittest.TestCase):
 				if not key in config or self.sample[key] != config[key]]
 		self.assertEqual(len(mismatch_keys), 0)
 
+	def test_write_distributed_config_json(self):
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample, '127.0.0.1',
+			codec='json')
+		znode = self.connection.get(self.path + '/mysql/reports/127.0.0.1')
+		self.assertEqual(znode[0][0], '{')
+		config = pettingzoo.discovery.decode_config(znode[0])
+		self.assertEqual(config, yaml.load(znode[0]))
+		mismatch_keys = [
+			key for key in self.sample
+				if not key in config or self.sample[key] != config[key]]
+		self.assertEqual(len(mismatch_keys), 0)
+
+	def test_write_distributed_config_msgpack(self):
+		try:
+			import msgpack
+		except ImportError:
+			self.skipTest("msgpack is not installed")
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample, '127.0.0.1',
+			codec='msgpack')
+		znode = self.connection.get(self.path + '/mysql/reports/127.0.0.1')
+		config = pettingzoo.discovery.decode_config(znode[0])
+		mismatch_keys = [
+			key for key in self.sample
+				if not key in config or self.sample[key] != config[key]]
+		self.assertEqual(len(mismatch_keys), 0)
+
+	def test_decode_config_yaml(self):
+		decode = pettingzoo.discovery.decode_config
+		self.assertEqual(decode(yaml.dump(self.sample)), self.sample)
+		self.assertEqual(
+			decode(yaml.dump(self.sample, default_flow_style=True)),
+			self.sample)
+		self.assertRaises(
+			Exception, pettingzoo.discovery.encode_config, self.sample, 'xml')
+
+	def test_write_distributed_configs(self):
+		memcached = {'header': {'service_class': 'memcached'}, 'port': 11211}
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', {
+				'header': {'service_class': 'mysql'}, 'host': 'old'},
+			'127.0.0.1')
+		key = pettingzoo.discovery.write_distributed_configs(
+			self.connection, [
+				('mysql', 'reports', self.sample),
+				('mysql', 'knewmena', copy.deepcopy(self.sample)),
+				('memcached', 'sessions', memcached)],
+			'127.0.0.1', codec='json')
+		self.assertEqual(key, '127.0.0.1')
+		for name in ['reports', 'knewmena']:
+			znode = self.connection.get(
+				self.path + '/mysql/%s/127.0.0.1' % name)
+			config = pettingzoo.discovery.decode_config(znode[0])
+			self.assertEqual(config['host'], 'localhost')
+			self.assertEqual(config['header']['metadata']['service_name'], name)
+			self.assertTrue(self.connection.is_ephemeral(
+				self.path + '/mysql/%s/127.0.0.1' % name))
+		znode = self.connection.get(
+			self.path + '/memcached/sessions/127.0.0.1')
+		config = pettingzoo.discovery.decode_config(znode[0])
+		self.assertEqual(config['port'], 11211)
+
+	def test_local_ip_cache(self):
+		pettingzoo.discovery.clear_local_ip_cache()
+		self.assertEqual(pettingzoo.discovery._get_local_ip('lo'), '127.0.0.1')
+		self.assertEqual(pettingzoo.discovery._local_ips, {'lo': '127.0.0.1'})
+		pettingzoo.discovery._local_ips['lo'] = '127.0.0.2'
+		key = pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample, interface='lo')
+		self.assertEqual(key, '127.0.0.2')
+		pettingzoo.discovery.clear_local_ip_cache('lo')
+		self.assertEqual(pettingzoo.discovery._local_ips, {})
+		self.assertRaises(
+			Exception, pettingzoo.discovery._get_local_ip, 'nosuchif0')
+		self.assertFalse('nosuchif0' in pettingzoo.discovery._local_ips)
+
 	def test_remove_stale_config(self):
 		pettingzoo.discovery.write_distributed_config(
 			self.connection, 'mysql', 'reports',
@@ -63,8 +144,12 @@ class DiscoveryTests(unittest.TestCase):
 		pettingzoo.discovery.CONFIG_PATH = '/discovery'
 		self.connection.close()
 		self.connection = connect_to_zk('127.0.0.1:2181')
-		self.connection.delete_recursive(self.path)
-		self.connection.close()
+		try:
+			self.connection.delete_recursive(self.path)
+		except zookeeper.NoNodeException:
+			pass # does not exist
+		finally:
+			self.connection.close()
 		if self.mock:
 			import zc.zk.testing
 			zc.zk.testing.tearDown(self)
@@ -114,6 +199,157 @@ class DistributedDiscoveryTests(unittest.TestCase):
 				if not key in config or self.sample[key] != config[key]]
 		self.assertEqual(len(mismatch_keys), 0)
 
+	def test_load_config_snapshot(self):
+		event = threading.Event()
+		def callback(path, config):
+			event.set()
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample, '127.0.0.1')
+		ddc = pettingzoo.discovery.DistributedDiscovery(self.connection)
+		ddc.load_config('mysql', 'reports', callback=callback)
+		config = ddc.load_config('mysql', 'reports')
+		self.assertTrue(ddc.load_config('mysql', 'reports') is config)
+		self.assertRaises(TypeError, config.__setitem__, 'host', 'foo')
+		self.assertRaises(TypeError, config['header'].pop, 'metadata')
+		self.assertEqual(config['header']['metadata']['key'], '127.0.0.1')
+		mutable = copy.deepcopy(config)
+		mutable['header']['service_class'] = 'other'
+		self.assertEqual(config['header']['service_class'], 'mysql')
+		self.assertEqual(
+			pettingzoo.local_config.load_yaml(
+				pettingzoo.local_config.dump_yaml(config)), config)
+		event.clear()
+		pettingzoo.discovery.remove_stale_config(
+			self.connection, 'mysql', 'reports', '127.0.0.1')
+		sample2 = copy.deepcopy(self.sample)
+		sample2['host'] = 'notlocalhost'
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', sample2, '127.0.0.2')
+		event.wait(0.25)
+		config = ddc.load_config('mysql', 'reports')
+		self.assertEqual(config['host'], 'notlocalhost')
+		self.assertTrue(ddc.load_config('mysql', 'reports') is config)
+
+	def test_load_config_snapshot_callback(self):
+		event = threading.Event()
+		received = []
+		def callback(path, config):
+			received.append(config)
+			if config:
+				event.set()
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample, '127.0.0.1')
+		ddc = pettingzoo.discovery.DistributedDiscovery(self.connection)
+		config = ddc.load_config('mysql', 'reports')
+		# registering another callback returns the snapshot already taken
+		self.assertTrue(
+			ddc.load_config('mysql', 'reports', callback=callback) is config)
+		self.assertEqual(received, [])
+		event.clear()
+		sample2 = copy.deepcopy(self.sample)
+		sample2['host'] = 'notlocalhost'
+		pettingzoo.discovery.remove_stale_config(
+			self.connection, 'mysql', 'reports', '127.0.0.1')
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', sample2, '127.0.0.2')
+		event.wait(0.25)
+		self.assertEqual(received[-1]['host'], 'notlocalhost')
+		config = ddc.load_config('mysql', 'reports', callback=callback)
+		self.assertEqual(config['host'], 'notlocalhost')
+		self.assertTrue(received[-1] is config)
+
+	def _write_boxes(self, **metadata):
+		for i, host in enumerate(['box1', 'box2']):
+			sample = copy.deepcopy(self.sample)
+			sample['host'] = host
+			for field, values in metadata.items():
+				sample['header']['metadata'][field] = values[i]
+			pettingzoo.discovery.write_distributed_config(
+				self.connection, 'mysql', 'reports', sample, host)
+
+	def test_round_robin_selection(self):
+		self._write_boxes()
+		ddc = pettingzoo.discovery.DistributedDiscovery(self.connection,
+			strategy=pettingzoo.discovery.RoundRobinSelection())
+		hosts = [ddc.load_config('mysql', 'reports')['host'] for _ in range(4)]
+		self.assertEqual(sorted(hosts), ['box1', 'box1', 'box2', 'box2'])
+		self.assertNotEqual(hosts[0], hosts[1])
+		self.assertEqual(hosts[0], hosts[2])
+
+	def test_weighted_selection(self):
+		self._write_boxes(weight=[0, 5])
+		ddc = pettingzoo.discovery.DistributedDiscovery(self.connection,
+			strategy=pettingzoo.discovery.WeightedSelection())
+		for _ in range(10):
+			self.assertEqual(ddc.load_config('mysql', 'reports')['host'], 'box2')
+
+	def test_locality_selection(self):
+		self._write_boxes(zone=['us-east-1a', 'us-east-1b'])
+		ddc = pettingzoo.discovery.DistributedDiscovery(self.connection,
+			strategy=pettingzoo.discovery.LocalitySelection('us-east-1b'))
+		for _ in range(10):
+			self.assertEqual(ddc.load_config('mysql', 'reports')['host'], 'box2')
+		ddc = pettingzoo.discovery.DistributedDiscovery(self.connection,
+			strategy=pettingzoo.discovery.LocalitySelection('us-west-2a'))
+		hosts = set(ddc.load_config('mysql', 'reports')['host']
+			for _ in range(50))
+		self.assertEqual(hosts, set(['box1', 'box2']))
+
+	def test_least_loaded_selection(self):
+		self._write_boxes()
+		strategy = pettingzoo.discovery.LeastLoadedSelection()
+		ddc = pettingzoo.discovery.DistributedDiscovery(
+			self.connection, strategy=strategy)
+		busy = ddc.load_config('mysql', 'reports')
+		with strategy.track(busy):
+			for _ in range(10):
+				config = ddc.load_config('mysql', 'reports')
+				self.assertNotEqual(config['host'], busy['host'])
+		self.assertEqual(strategy.in_flight, {})
+
+	def test_selection_with_callback(self):
+		self.cbconfig = None
+		event = threading.Event()
+		def callback(path, config):
+			self.cbconfig = config
+			event.set()
+		self._write_boxes()
+		ddc = pettingzoo.discovery.DistributedDiscovery(self.connection,
+			strategy=pettingzoo.discovery.RoundRobinSelection())
+		ddc.load_config('mysql', 'reports', callback=callback)
+		event.clear()
+		pettingzoo.discovery.remove_stale_config(
+			self.connection, 'mysql', 'reports', 'box1')
+		event.wait(0.25)
+		self.assertEqual(self.cbconfig['host'], 'box2')
+		for _ in range(3):
+			self.assertEqual(ddc.load_config('mysql', 'reports')['host'], 'box2')
+
+	def test_selection_callback_snapshot(self):
+		selected = []
+		class Recording(pettingzoo.discovery.RoundRobinSelection):
+			def select(self, path, configs):
+				selected.append(configs)
+				return super(Recording, self).select(path, configs)
+		event = threading.Event()
+		def callback(path, config):
+			event.set()
+		self._write_boxes()
+		ddc = pettingzoo.discovery.DistributedDiscovery(self.connection,
+			strategy=Recording())
+		ddc.load_config('mysql', 'reports', callback=callback)
+		event.wait(0.25)
+		event.clear()
+		pettingzoo.discovery.remove_stale_config(
+			self.connection, 'mysql', 'reports', 'box1')
+		event.wait(0.25)
+		config = ddc.load_config('mysql', 'reports')
+		# the callback selected from the snapshot load_config uses
+		self.assertTrue(selected[-2] is selected[-1])
+		self.assertTrue(isinstance(selected[-1], tuple))
+		self.assertEqual(config['header']['metadata']['service_name'], 'reports')
+		self.assertRaises(TypeError, config.__setitem__, 'host', 'box3')
+
 	def test_load_config_via_path(self):
 		pettingzoo.discovery.write_distributed_config(
 			self.connection, 'mysql', 'reports', self.sample, '127.0.0.1')
@@ -173,6 +409,28 @@ class DistributedDiscoveryTests(unittest.TestCase):
 		for key in mismatch_keys:
 			self.assertTrue(key in ['host', 'header'])
 
+	def test_load_config_after_removal(self):
+		self.cbconfig = None
+		event = threading.Event()
+		def callback(path, config):
+			self.cbconfig = config
+			event.set()
+		sample2 = copy.deepcopy(self.sample)
+		sample2['host'] = 'notlocalhost'
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample, '127.0.0.1')
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', sample2, '127.0.0.2')
+		ddc = pettingzoo.discovery.DistributedDiscovery(self.connection)
+		ddc.load_config('mysql', 'reports', callback=callback)
+		event.clear()
+		pettingzoo.discovery.remove_stale_config(
+			self.connection, 'mysql', 'reports', '127.0.0.1')
+		event.wait(0.25)
+		self.assertEqual(self.cbconfig['host'], 'notlocalhost')
+		self.assertEqual(
+			ddc.configs[self.path + '/mysql/reports'].keys(), ['127.0.0.2'])
+
 	def test_load_config_with_multiple_entries(self):
 		pettingzoo.discovery.write_distributed_config(
 			self.connection, 'mysql', 'reports', self.sample, '127.0.0.1')
@@ -241,6 +499,12 @@ class DistributedMultiDiscovery(unittest.TestCase):
 			'encoding': 'utf8'
 		}
 
+	def wait_for(self, condition, timeout=1.0):
+		"""Polls condition until it holds, as callbacks are dispatched."""
+		deadline = time.time() + timeout
+		while not condition() and time.time() < deadline:
+			time.sleep(0.01)
+
 	def test_config_dne(self):
 		dmc = pettingzoo.discovery.DistributedMultiDiscovery(self.connection)
 		self.assertRaises(IOError, dmc.load_config, "doesn't", "exist")
@@ -257,6 +521,17 @@ class DistributedMultiDiscovery(unittest.TestCase):
 				if not key in config or self.sample[key] != config[key]]
 		self.assertEqual(len(mismatch_keys), 0)
 
+	def test_load_config_mixed_codecs(self):
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample, '127.0.0.1')
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample2, '127.0.0.2',
+			codec='json')
+		dmc = pettingzoo.discovery.DistributedMultiDiscovery(self.connection)
+		configs = dmc.load_config('mysql', 'reports')
+		hosts = set([config['host'] for config in configs])
+		self.assertEquals(hosts, set(['localhost', 'notlocalhost']))
+
 	def test_load_config_with_multiple_entries(self):
 		pettingzoo.discovery.write_distributed_config(
 			self.connection, 'mysql', 'reports', self.sample, '127.0.0.1')
@@ -273,6 +548,233 @@ class DistributedMultiDiscovery(unittest.TestCase):
 			ips.remove(config['header']['metadata']['key'])
 		self.assertEquals(len(ips), 0)
 
+	def test_load_config_sequential(self):
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample, '127.0.0.1')
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample2, '127.0.0.2')
+		dmc = pettingzoo.discovery.DistributedMultiDiscovery(
+			self.connection, pipelined=False)
+		configs = dmc.load_config('mysql', 'reports')
+		self.assertEquals(len(configs), 2)
+		hosts = set([config['host'] for config in configs])
+		self.assertEquals(hosts, set(['localhost', 'notlocalhost']))
+
+	def test_load_config_with_callback(self):
+		event = threading.Event()
+		self.cbconfigs = None
+		def callback(path, configs):
+			self.cbconfigs = configs
+			if len(configs) == 2:
+				event.set()
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample, '127.0.0.1')
+		dmc = pettingzoo.discovery.DistributedMultiDiscovery(self.connection)
+		configs = dmc.load_config('mysql', 'reports', callback=callback)
+		self.assertEquals(len(configs), 1)
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample2, '127.0.0.2')
+		event.wait(0.25)
+		self.assertEquals(len(self.cbconfigs), 2)
+		hosts = set([config['host'] for config in self.cbconfigs])
+		self.assertEquals(hosts, set(['localhost', 'notlocalhost']))
+		self.assertEquals(len(dmc.load_config('mysql', 'reports')), 2)
+
+	def test_child_diff(self):
+		event = threading.Event()
+		expected = [1]
+		def callback(path, configs):
+			if len(configs) == expected[0]:
+				event.set()
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample, '127.0.0.1')
+		dmc = pettingzoo.discovery.DistributedMultiDiscovery(self.connection)
+		dmc.load_config('mysql', 'reports', callback=callback)
+		path = self.path + '/mysql/reports'
+		first = dmc.configs[path]['127.0.0.1']
+		event.clear()
+		expected[0] = 2
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample2, '127.0.0.2')
+		event.wait(0.25)
+		self.assertEquals(
+			sorted(dmc.configs[path].keys()), ['127.0.0.1', '127.0.0.2'])
+		self.assertTrue(dmc.configs[path]['127.0.0.1'] is first)
+		event.clear()
+		expected[0] = 1
+		pettingzoo.discovery.remove_stale_config(
+			self.connection, 'mysql', 'reports', '127.0.0.1')
+		event.wait(0.25)
+		self.assertEquals(dmc.configs[path].keys(), ['127.0.0.2'])
+		configs = dmc.load_config('mysql', 'reports')
+		self.assertEquals(len(configs), 1)
+		self.assertEquals(configs[0]['host'], 'notlocalhost')
+
+	def test_child_diff_changed_key(self):
+		import pettingzoo.testing
+		self.addCleanup(setattr, zc.zk.testing.Node, 'meta',
+			zc.zk.testing.Node.meta)
+		zc.zk.testing.Node.meta = pettingzoo.testing.meta
+		event = threading.Event()
+		def callback(path, configs):
+			if configs and configs[0]['host'] == 'notlocalhost':
+				event.set()
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample, '127.0.0.1')
+		dmc = pettingzoo.discovery.DistributedMultiDiscovery(self.connection)
+		dmc.load_config('mysql', 'reports', callback=callback)
+		# a key written again without a child event is seen by its own watch
+		self.connection.set(self.path + '/mysql/reports/127.0.0.1',
+			yaml.dump(self.sample2))
+		event.wait(1.0)
+		configs = dmc.load_config('mysql', 'reports')
+		self.assertEquals([config['host'] for config in configs],
+			['notlocalhost'])
+		# so is one deleted and created again
+		event.clear()
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample2, '127.0.0.1')
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample, '127.0.0.2')
+		self.wait_for(lambda: len(dmc.load_config('mysql', 'reports')) == 2)
+		configs = dmc.load_config('mysql', 'reports')
+		self.assertEquals(sorted(config['host'] for config in configs),
+			['localhost', 'notlocalhost'])
+
+	def test_child_diff_reads_added(self):
+		"""
+		Tests that a box joining a pool is the only child read, and that no
+		other child is stat'ed.
+		"""
+		for index in range(20):
+			pettingzoo.discovery.write_distributed_config(
+				self.connection, 'mysql', 'reports', self.sample,
+				'127.0.0.%s' % (index + 10))
+		connection = connect_to_zk(self.conn_string)
+		calls = []
+		def counted(name):
+			method = getattr(connection, name)
+			def call(*args):
+				calls.append((name, args[0]))
+				return method(*args)
+			setattr(connection, name, call)
+		for name in ('aget', 'get', 'aexists', 'exists'):
+			counted(name)
+		dmc = pettingzoo.discovery.DistributedMultiDiscovery(connection)
+		self.assertEquals(len(dmc.load_config('mysql', 'reports')), 20)
+		del calls[:]
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample2, '127.0.0.2')
+		self.wait_for(lambda: len(dmc.load_config('mysql', 'reports')) == 21)
+		self.assertEquals(calls,
+			[('aget', self.path + '/mysql/reports/127.0.0.2')])
+		connection.close()
+
+	def test_child_diff_expired(self):
+		import pettingzoo.testing
+		self.addCleanup(setattr, zc.zk.testing.Session, 'expire',
+			zc.zk.testing.Session.expire)
+		zc.zk.testing.Session.expire = pettingzoo.testing.expire
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample, '127.0.0.1')
+		connection = connect_to_zk(self.conn_string)
+		dmc = pettingzoo.discovery.DistributedMultiDiscovery(connection)
+		dmc.load_config('mysql', 'reports')
+		self.ZooKeeper.sessions[connection.handle].expire()
+		self.wait_for(connection.connected.is_set)
+		# the data watches expired with the session, and are set again
+		self.connection.set(self.path + '/mysql/reports/127.0.0.1',
+			yaml.dump(self.sample2))
+		self.wait_for(lambda: dmc.load_config(
+			'mysql', 'reports')[0]['host'] == 'notlocalhost')
+		configs = dmc.load_config('mysql', 'reports')
+		self.assertEquals(configs[0]['host'], 'notlocalhost')
+		connection.close()
+
+	def test_parsed_config_cache(self):
+		import pettingzoo.testing
+		self.addCleanup(setattr, zc.zk.testing.Node, 'meta',
+			zc.zk.testing.Node.meta)
+		zc.zk.testing.Node.meta = pettingzoo.testing.meta
+		pettingzoo.discovery.parsed_configs.clear()
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample, '127.0.0.1')
+		path = self.path + '/mysql/reports'
+		dmc = pettingzoo.discovery.DistributedMultiDiscovery(self.connection)
+		# changing a returned config must not change the shared parse
+		dmc.load_config('mysql', 'reports')[0]['host'] = 'changed'
+		dmc2 = pettingzoo.discovery.DistributedMultiDiscovery(self.connection)
+		configs = dmc2.load_config('mysql', 'reports')
+		self.assertEquals(configs[0]['host'], 'localhost')
+		self.assertTrue(
+			dmc.configs[path]['127.0.0.1'] is dmc2.configs[path]['127.0.0.1'])
+		self.assertEquals(len(pettingzoo.discovery.parsed_configs), 1)
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample2, '127.0.0.1')
+		dmc3 = pettingzoo.discovery.DistributedMultiDiscovery(self.connection)
+		configs = dmc3.load_config('mysql', 'reports')
+		self.assertEquals(configs[0]['host'], 'notlocalhost')
+		self.assertEquals(len(pettingzoo.discovery.parsed_configs), 2)
+
+	def test_multi_load_config_snapshot(self):
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample, '127.0.0.1')
+		dmc = pettingzoo.discovery.DistributedMultiDiscovery(self.connection)
+		first = dmc.load_config('mysql', 'reports')
+		second = dmc.load_config('mysql', 'reports')
+		# decorated once: the calls share everything below the top level
+		self.assertTrue(first[0] is not second[0])
+		self.assertTrue(first[0]['header'] is second[0]['header'])
+		self.assertRaises(TypeError,
+			first[0]['header'].__setitem__, 'service_class', 'changed')
+		first[0]['host'] = 'changed'
+		self.assertEqual(second[0]['host'], 'localhost')
+		self.assertEqual(
+			dmc.load_config('mysql', 'reports')[0]['host'], 'localhost')
+
+	def test_callback_configs_are_copies(self):
+		received = []
+		def callback(path, configs):
+			received.append(configs)
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample, '127.0.0.1')
+		dmc = pettingzoo.discovery.DistributedMultiDiscovery(self.connection)
+		dmc.load_config('mysql', 'reports', callback=callback)
+		# registering the watch calls back right away
+		self.assertEqual(len(received), 1)
+		received[0][0]['host'] = 'changed'
+		configs = dmc.load_config('mysql', 'reports')
+		self.assertEqual(configs[0]['host'], 'localhost')
+
+	def test_get_many(self):
+		pettingzoo.discovery.write_distributed_config(
+			self.connection, 'mysql', 'reports', self.sample, '127.0.0.1')
+		path = self.path + '/mysql/reports/'
+		znodes = pettingzoo.utils.get_many(
+			self.connection, [path + '127.0.0.1', path + '127.0.0.2'])
+		self.assertEquals(znodes.keys(), [path + '127.0.0.1'])
+		config = yaml.load(znodes[path + '127.0.0.1'][0])
+		self.assertEquals(config['host'], 'localhost')
+
+	def test_get_many_timeout(self):
+		"""
+		Tests that get_many and run_many raise rather than hang when a
+		completion never arrives.
+		"""
+		class LostCompletions(object):
+			def aget(self, path, watch, completion):
+				pass
+			def acreate(self, path, data, acl, flags, completion):
+				pass
+		# for tearDown
+		self.connection.create_recursive(
+			self.path, "", acl=zc.zk.OPEN_ACL_UNSAFE)
+		connection = LostCompletions()
+		self.assertRaises(Exception, pettingzoo.utils.get_many,
+			connection, ['/lost'], timeout=0.05)
+		self.assertRaises(Exception, pettingzoo.utils.run_many,
+			[(connection.acreate, ('/lost', '', [], 0))], timeout=0.05)
+
 	def tearDown(self):
 		pettingzoo.discovery.CONFIG_PATH = '/discovery'
 		self.connection.close()
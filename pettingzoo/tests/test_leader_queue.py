@@ -1,3 +1,4 @@
+import time
 import unittest
 import threading
 import zc.zk.testing
@@ -5,6 +6,13 @@ import pettingzoo.utils
 import pettingzoo.testing
 from pettingzoo.leader_queue import *
 
+def setUpModule():
+	# setUp binds the mock's methods before it patches them, which leaves the
+	# first test of a run unpatched
+	zc.zk.testing.ZooKeeper.create = pettingzoo.testing.create
+	zc.zk.testing.ZooKeeper.exists = pettingzoo.testing.exists
+	zc.zk.testing.Node.deleted = pettingzoo.testing.deleted
+
 class TestCandidate(Candidate):
 	def on_elected(self):
 		pass
@@ -22,6 +30,12 @@ class LeaderQueueTests(unittest.TestCase):
 		self.path = '/test_leaderq'
 		pettingzoo.utils.configure_logger()
 
+	def wait_for(self, condition, timeout=1.0):
+		"""Polls condition until it holds, as on_elected is dispatched."""
+		deadline = time.time() + timeout
+		while not condition() and time.time() < deadline:
+			time.sleep(0.01)
+
 	def test_lq_create(self):
 		"""
 		Tests that creation of a leader queue creates the appropriate needed
@@ -121,6 +135,150 @@ class LeaderQueueTests(unittest.TestCase):
 		self.assertTrue(leaderq.remove_candidate(cands[1]))
 		self.assertEqual(leaderq.candidate_by_predecessor[2], cands[3])
 
+	def test_predecessor_index(self):
+		"""
+		Tests that the counter index follows the queue, including candidates
+		added by another process, and is used to find predecessors.
+		"""
+		leaderq = LeaderQueue(self.connection, self.path)
+		other = LeaderQueue(self.connection, self.path)
+		cands = self._create_candidates(leaderq, num_candidates=2)
+		self._create_candidates(other, num_candidates=1)
+		cands.extend(self._create_candidates(leaderq, num_candidates=1))
+		self.assertEqual(leaderq.counters, [0, 1, 2, 3])
+		self.assertEqual(leaderq.candidate_by_predecessor[2], cands[2])
+		self.assertTrue(leaderq.remove_candidate(cands[1]))
+		self.assertEqual(leaderq.counters, [0, 2, 3])
+		self.assertEqual(leaderq._find_predecessor(2), 0)
+		self.assertEqual(leaderq._find_predecessor(0), -1)
+
+	def test_predecessor_chain_remove_middle(self):
+		"""
+		Tests that removing candidates from the middle of the queue, through
+		remove_candidate or by their node going away, relinks the chain so
+		that only the next candidate still queued is elected.
+		"""
+		elected = []
+		class ElectedCandidate(Candidate):
+			def on_elected(slf):
+				elected.append(slf)
+		leaderq = LeaderQueue(self.connection, self.path)
+		cands = [ElectedCandidate() for _ in range(4)]
+		for cand in cands:
+			self.assertTrue(leaderq.add_candidate(cand))
+		self.wait_for(lambda: elected == [cands[0]])
+		self.assertTrue(leaderq.remove_candidate(cands[1]))
+		self.assertEqual(leaderq.predecessor_by_candidate[cands[2]], 0)
+		self.assertEqual(leaderq.candidate_by_predecessor[0], cands[2])
+		# looking up a removed counter must not put it back in the index
+		self.assertEqual(leaderq._find_predecessor(1), 0)
+		self.assertEqual(leaderq.counters, [0, 2, 3])
+		self.connection.delete(id_to_item_path(self.path, 2))
+		self.wait_for(lambda: leaderq.counters == [0, 3])
+		self.assertEqual(leaderq.counters, [0, 3])
+		self.assertEqual(leaderq.predecessor_by_candidate[cands[3]], 0)
+		self.assertEqual(leaderq.candidate_by_predecessor[0], cands[3])
+		self.assertEqual(leaderq._find_predecessor(3), 0)
+		self.connection.delete(id_to_item_path(self.path, 0))
+		self.wait_for(lambda: len(elected) == 2)
+		self.assertEqual(elected, [cands[0], cands[3]])
+		self.assertEqual(leaderq.candidate_by_predecessor, {-1: cands[3]})
+
+	def test_remove_candidate_predecessor_index(self):
+		"""
+		Tests that remove_candidate drops the candidate from the predecessor
+		index, so it is not handed the queue when the node it waited on goes
+		away.
+		"""
+		leaderq = LeaderQueue(self.connection, self.path)
+		cands = [TestCandidate() for _ in range(3)]
+		for cand in cands:
+			self.assertTrue(leaderq.add_candidate(cand))
+		self.assertTrue(leaderq.remove_candidate(cands[2]))
+		self.assertFalse(cands[2] in leaderq.predecessor_by_candidate)
+		self.assertEqual(leaderq.candidate_by_predecessor, {
+			-1: cands[0], 0: cands[1]})
+		self.assertTrue(leaderq.remove_candidate(cands[1]))
+		self.assertEqual(leaderq.candidate_by_predecessor, {-1: cands[0]})
+		self.assertEqual(leaderq.predecessor_by_candidate, {cands[0]: -1})
+
+	def test_add_candidates(self):
+		"""
+		Tests that add_candidates enrols every candidate, resolves their
+		futures, and elects the first one.
+		"""
+		elected = []
+		event = threading.Event()
+		class ElectedCandidate(Candidate):
+			def on_elected(slf):
+				elected.append(slf)
+				event.set()
+		leaderq = LeaderQueue(self.connection, self.path)
+		cands = [ElectedCandidate() for _ in range(5)]
+		futures = leaderq.add_candidates(cands)
+		self.assertEqual([f.result(1) for f in futures], [True] * 5)
+		self.assertEqual(
+			sorted(leaderq.counter_by_candidate.values()), range(5))
+		self.assertFalse(leaderq.add_candidate_async(cands[0]).result(1))
+		event.wait(0.25)
+		first = [c for c in cands if leaderq.counter_by_candidate[c] == 0]
+		self.assertEqual(elected, first)
+		self.assertEqual(leaderq.pending_candidates, set())
+
+	def test_add_candidates_pipelined_watches(self):
+		"""
+		Tests that add_candidates sets the deletion watches of a batch with
+		async calls rather than one exists per candidate.
+		"""
+		calls = []
+		def counted(name):
+			method = getattr(zookeeper, name)
+			def call(handle, path, *args):
+				calls.append((name, path))
+				return method(handle, path, *args)
+			self.addCleanup(setattr, zookeeper, name, method)
+			setattr(zookeeper, name, call)
+		leaderq = LeaderQueue(self.connection, self.path)
+		counted('exists')
+		counted('aexists')
+		futures = leaderq.add_candidates(
+			[TestCandidate() for _ in range(5)])
+		self.assertEqual([f.result(1) for f in futures], [True] * 5)
+		self.assertEqual(sorted(calls), [
+			('aexists', id_to_item_path(self.path, counter))
+			for counter in range(5)])
+		self.assertEqual(sorted(leaderq.deletion_handlers), range(5))
+
+	def test_add_candidates_node_gone(self):
+		"""
+		Tests that a candidate whose node goes away before add_candidates
+		gets to watch it is treated as removed, and the next in line is
+		elected.
+		"""
+		elected = []
+		class ElectedCandidate(Candidate):
+			def on_elected(slf):
+				elected.append(slf)
+		dispatcher = pettingzoo.utils.Dispatcher(workers=1)
+		leaderq = LeaderQueue(self.connection, self.path, dispatcher)
+		blocked = threading.Event()
+		# holds back the enrolments, which are keyed by the queue
+		dispatcher.submit(leaderq, blocked.wait, 1)
+		cands = [ElectedCandidate() for _ in range(2)]
+		futures = leaderq.add_candidates(cands)
+		self.wait_for(lambda: len(
+			self.connection.children(self.path + "/candidate")) == 2)
+		self.connection.delete(id_to_item_path(self.path, 0))
+		blocked.set()
+		results = [f.result(1) for f in futures]
+		self.assertEqual(sorted(results), [False, True])
+		# the mock's async creates may number the candidates in either order
+		gone, survivor = cands[results.index(False)], cands[results.index(True)]
+		self.wait_for(lambda: elected == [survivor])
+		self.assertEqual(elected, [survivor])
+		self.assertEqual(leaderq.counters, [1])
+		self.assertFalse(leaderq.has_candidate(gone))
+
 	def test_on_elected(self):
 		"""
 		Tests that on_elected gets called on the candidate when
@@ -143,6 +301,204 @@ class LeaderQueueTests(unittest.TestCase):
 		event.wait(0.25)
 		self.assertTrue(self.touched)
 
+	def test_handoff_listener(self):
+		"""
+		Tests that handoff listeners hear about a candidate elected because
+		its predecessor was deleted, but not about the first leader.
+		"""
+		handoffs = []
+		event = threading.Event()
+		def listener(candidate, seconds):
+			handoffs.append((candidate, seconds))
+			event.set()
+		leaderq = LeaderQueue(self.connection, self.path)
+		leaderq.add_handoff_listener(listener)
+		cands = self._create_candidates(leaderq, num_candidates=2)
+		self.connection.delete(id_to_item_path(self.path, 0))
+		event.wait(0.25)
+		self.assertEqual(len(handoffs), 1)
+		self.assertEqual(handoffs[0][0], cands[1])
+		self.assertTrue(handoffs[0][1] >= 0)
+
+	def test_group(self):
+		"""
+		Tests that a LeaderQueueGroup creates one queue per path and elects
+		a leader in each of them.
+		"""
+		elected = []
+		class ElectedCandidate(Candidate):
+			def on_elected(slf):
+				elected.append(slf)
+		group = LeaderQueueGroup(self.connection)
+		paths = [self.path + "/shard%s" % index for index in range(3)]
+		cands = dict((path, [ElectedCandidate(), ElectedCandidate()])
+			for path in paths)
+		futures = group.add_candidates(cands)
+		for path in paths:
+			self.assertEqual([f.result(1) for f in futures[path]], [True, True])
+			self.assertTrue(group.get_queue(path) is group.queues[path])
+			self.assertTrue(group.get_queue(path).lock is group.lock)
+		self.assertEqual(len(group.queues), 3)
+		self.wait_for(lambda: len(elected) == 3)
+		self.assertEqual(
+			sorted(id(c) for c in elected),
+			sorted(id(c) for path in paths
+				for c in cands[path]
+				if group.queues[path].counter_by_candidate[c] == 0))
+		self.assertTrue(group.remove_candidate(paths[0], cands[paths[0]][0]))
+		self.assertFalse(group.remove_candidate(self.path + "/none", None))
+
+	def test_balanced_group(self):
+		"""
+		Tests that a BalancedLeaderQueueGroup steps back from half of its
+		elections when a second process contests the same paths.
+		"""
+		class SimCandidate(Candidate):
+			def __init__(slf, leading):
+				slf.leading = leading
+			def on_elected(slf):
+				slf.leading.append(slf)
+			def on_revoked(slf):
+				slf.leading.remove(slf)
+		paths = [self.path + "/shard%s" % index for index in range(4)]
+		leading = [[], []]
+		groups = []
+		for index in range(2):
+			connection = pettingzoo.utils.connect_to_zk(self.conn_string)
+			group = BalancedLeaderQueueGroup(connection)
+			futures = group.add_candidates(dict(
+				(path, [SimCandidate(leading[index])]) for path in paths))
+			for path in paths:
+				self.assertTrue(futures[path][0].result(1))
+			groups.append(group)
+			self.wait_for(lambda: len(leading[0]) + len(leading[1]) == 4)
+		self.wait_for(lambda: [len(l) for l in leading] == [2, 2])
+		self.assertEqual([len(l) for l in leading], [2, 2])
+		self.assertEqual(
+			groups[0].get_leading() | groups[1].get_leading(), set(paths))
+		self.assertEqual(groups[0].get_leading() & groups[1].get_leading(),
+			frozenset())
+		for group in groups:
+			group.connection.close()
+
+	def test_balanced_step_back_order(self):
+		"""
+		Tests that a BalancedLeaderQueueGroup calls on_revoked while its
+		candidate is still enrolled, so the next leader is only elected once
+		on_revoked has returned.
+		"""
+		groups = []
+		revoked = []
+		class SimCandidate(Candidate):
+			def __init__(slf, index, path):
+				slf.index = index
+				slf.path = path
+			def on_elected(slf):
+				pass
+			def on_revoked(slf):
+				group = groups[slf.index]
+				queue = group.queues[slf.path]
+				revoked.append(queue.has_candidate(group.contested[slf.path]))
+		paths = [self.path + "/shard%s" % index for index in range(2)]
+		for index in range(2):
+			connection = pettingzoo.utils.connect_to_zk(self.conn_string)
+			group = BalancedLeaderQueueGroup(connection)
+			groups.append(group)
+			futures = group.add_candidates(dict(
+				(path, [SimCandidate(index, path)]) for path in paths))
+			for path in paths:
+				self.assertTrue(futures[path][0].result(1))
+		self.wait_for(lambda: [len(g.get_leading()) for g in groups] == [1, 1])
+		self.assertEqual([len(g.get_leading()) for g in groups], [1, 1])
+		self.assertEqual(revoked, [True])
+		for group in groups:
+			group.connection.close()
+
+	def test_is_leader(self):
+		"""
+		Tests that is_leader follows elections, and that leadership is
+		revoked on disconnect and given back on reconnect.
+		"""
+		events = []
+		class TrackedCandidate(Candidate):
+			def on_elected(slf):
+				events.append(('elected', slf))
+			def on_revoked(slf):
+				events.append(('revoked', slf))
+		leaderq = LeaderQueue(self.connection, self.path)
+		first, second = TrackedCandidate(), TrackedCandidate()
+		leaderq.add_candidate(first)
+		leaderq.add_candidate(second)
+		self.wait_for(lambda: leaderq.is_leader(first))
+		self.assertTrue(leaderq.is_leader(first))
+		self.assertFalse(leaderq.is_leader(second))
+		session = self.ZooKeeper.sessions[self.connection.handle]
+		session.disconnect()
+		self.assertFalse(leaderq.is_leader(first))
+		self.wait_for(lambda: ('revoked', first) in events)
+		self.assertEqual(events, [('elected', first), ('revoked', first)])
+		session.connect()
+		self.wait_for(lambda: leaderq.is_leader(first))
+		self.assertEqual(events[-1], ('elected', first))
+		self.assertTrue(leaderq.is_leader(first))
+		self.assertFalse(leaderq.is_leader(second))
+		leaderq.remove_candidate(first)
+		self.wait_for(lambda: leaderq.is_leader(second))
+		self.assertFalse(leaderq.is_leader(first))
+		self.assertTrue(leaderq.is_leader(second))
+
+	def test_session_expired(self):
+		"""
+		Tests that candidates are dropped with an expired session, and that
+		they can then be added again.
+		"""
+		self.addCleanup(setattr, zc.zk.testing.Session, 'expire',
+			zc.zk.testing.Session.expire)
+		zc.zk.testing.Session.expire = pettingzoo.testing.expire
+		events = []
+		class TrackedCandidate(Candidate):
+			def on_elected(slf):
+				events.append(('elected', slf))
+			def on_revoked(slf):
+				events.append(('revoked', slf))
+		leaderq = LeaderQueue(self.connection, self.path)
+		first, second = TrackedCandidate(), TrackedCandidate()
+		leaderq.add_candidate(first)
+		leaderq.add_candidate(second)
+		self.wait_for(lambda: leaderq.is_leader(first))
+		self.ZooKeeper.sessions[self.connection.handle].expire()
+		self.wait_for(lambda: ('revoked', first) in events)
+		self.assertEqual(events, [('elected', first), ('revoked', first)])
+		self.assertFalse(leaderq.has_candidate(first))
+		self.assertFalse(leaderq.has_candidate(second))
+		self.assertEqual(leaderq.deletion_handlers, {})
+		self.wait_for(self.connection.connected.is_set)
+		self.assertTrue(leaderq.add_candidate(second))
+		self.assertTrue(leaderq.add_candidate(first))
+		self.wait_for(lambda: leaderq.is_leader(second))
+		self.assertTrue(leaderq.is_leader(second))
+		self.assertFalse(leaderq.is_leader(first))
+
+	def test_concurrent_add(self):
+		"""
+		Tests that a candidate added from many threads at once is only
+		enrolled once.
+		"""
+		leaderq = LeaderQueue(self.connection, self.path)
+		cand = TestCandidate()
+		results = []
+		def add():
+			results.append(leaderq.add_candidate(cand))
+		threads = [threading.Thread(target=add) for _ in range(8)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(sorted(results), [False] * 7 + [True])
+		children = [child for child in self.connection.children(
+			self.path + "/candidate")]
+		self.assertEqual(len(children), 1)
+
 	def test_id_to_item_path(self):
 		"""
 		Tests that id_to_item_path returns an appropriate path
@@ -1,4 +1,5 @@
 import unittest
+import yaml
 import pettingzoo.local_config
 import os
 
@@ -85,6 +86,14 @@ class ConfigTests(unittest.TestCase):
 		payload2 = pettingzoo.local_config.LocalConfig().fetch_config('memcached/sessions.yml')
 		self.assertEqual(cache['memcached/sessions.yml__None'], payload2)
 
+	def test_load_yaml(self):
+		payload = pettingzoo.local_config.dump_yaml({'a': [1, 2], 'b': 'c'})
+		self.assertEqual(
+			pettingzoo.local_config.load_yaml(payload), {'a': [1, 2], 'b': 'c'})
+		self.assertRaises(
+			yaml.YAMLError, pettingzoo.local_config.load_yaml,
+			"!!python/object/apply:os.getpid []")
+
 	def test_discovery(self):
 		payload = pettingzoo.local_config.LocalConfig().fetch_discovery('mysql', 'reports')
 		self.assertTrue('server_list' in payload.keys())
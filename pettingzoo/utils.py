@@ -1,11 +1,19 @@
 import zc.zk
 import zookeeper
+import thread
 import threading
+import time
+import collections
+import Queue
+import yaml
 import sys
 import traceback
 import logging
 import logging.config
 
+# seconds get_many and run_many wait for their completions
+DEFAULT_TIMEOUT = 30.0
+
 def connect_to_zk(servers, **kwargs):
 	"""
 	Function used to connect to zookeeper for pettingzoo.multiprocessing.
@@ -61,6 +69,110 @@ def max_counter(children):
 		numbers.append(counter_value(child))
 	return max(numbers)
 
+def aget_many(connection, paths, completion, watcher=None):
+	"""
+	Pipelines reads of many znodes using the zookeeper async api.  All reads
+	are issued at once, and completion is called a single time, from the
+	zookeeper completion thread, once every read has finished.
+
+	:param connection: a zc.zk.ZooKeeper connection
+	:param paths: an iterable of znode paths to read
+	:param completion: callback in the form of some_callback(results) where \
+	  results is a dict of path to (data, stat).  Paths that no longer exist \
+	  are left out of results.
+	:param watcher: (Optional) data watch to set on every znode read
+	:rtype: None
+	"""
+	paths = list(paths)
+	results = {}
+	lock = threading.Lock()
+	pending = [len(paths)]
+	if not paths:
+		completion(results)
+		return
+	def make_completion(path):
+		def on_get(handle, status, data=None, stat=None):
+			with lock:
+				if status == zookeeper.OK:
+					results[path] = (data, stat)
+				elif status != zookeeper.NONODE:
+					get_logger().warning("aget_many %s: %s" %
+						(path, zookeeper.zerror(status)))
+				pending[0] -= 1
+				finished = pending[0] == 0
+			if finished:
+				completion(results)
+		return on_get
+	for path in paths:
+		connection.aget(path, watcher, make_completion(path))
+
+def get_many(connection, paths, timeout=DEFAULT_TIMEOUT, watcher=None):
+	"""
+	Blocking version of aget_many.  Returns once every read has finished.
+
+	:param connection: a zc.zk.ZooKeeper connection
+	:param paths: an iterable of znode paths to read
+	:param timeout: (Default DEFAULT_TIMEOUT) seconds to wait for the reads
+	:param watcher: (Optional) data watch to set on every znode read
+	:rtype: *dict* of path to (data, stat) for every path that exists
+
+	**Note**
+
+	This waits on completions delivered by the zookeeper completion thread,
+	so it must never be called from the zookeeper event thread, that is from
+	inside a watch or completion callback: it would wait for itself until
+	the timeout.  Use aget_many there instead.  An Exception is raised if
+	the reads do not all complete within timeout, for instance because the
+	session expired.
+	"""
+	done = threading.Event()
+	gathered = {}
+	def completion(results):
+		gathered.update(results)
+		done.set()
+	aget_many(connection, paths, completion, watcher)
+	if not done.wait(timeout):
+		raise Exception("get_many timed out after %s seconds" % (timeout))
+	return gathered
+
+def run_many(calls, timeout=DEFAULT_TIMEOUT):
+	"""
+	Issues many zookeeper async calls at once and waits for all of them to
+	complete.
+
+	:param calls: a list of (function, args) pairs, where function is an async \
+	  method of a zc.zk.ZooKeeper connection (acreate, adelete, aexists...) \
+	  that takes its completion as the argument after args.
+	:param timeout: (Default DEFAULT_TIMEOUT) seconds to wait for the calls
+	:rtype: *list* of (status, results) for each call, in the order of calls
+
+	**Note**
+
+	Like get_many, this must never be called from the zookeeper event
+	thread, and raises an Exception if the calls do not all complete within
+	timeout.
+	"""
+	results = [None] * len(calls)
+	if not calls:
+		return results
+	done = threading.Event()
+	lock = threading.Lock()
+	pending = [len(calls)]
+	def make_completion(index):
+		def completion(handle, status, *args):
+			with lock:
+				results[index] = (status, args)
+				pending[0] -= 1
+				finished = pending[0] == 0
+			if finished:
+				done.set()
+		return completion
+	for index, (function, args) in enumerate(calls):
+		function(*(tuple(args) + (make_completion(index),)))
+	if not done.wait(timeout):
+		raise Exception("run_many timed out after %s seconds" % (timeout))
+	return results
+
 def configure_logger(config_file=None, **kwargs):
 	if config_file:
 		logging.config.fileConfig(config_file)
@@ -147,3 +259,396 @@ class ReadWriteLock:
 		"""Release a write-lock."""
 		self._read_ready.release()
 
+class FairReadWriteLock(object):
+	"""
+	A read write lock that prefers writers.  Once a writer is waiting, new
+	readers queue behind it, so a steady stream of readers can not starve
+	writers the way they can with ReadWriteLock.  Waiters are served in the
+	order they arrived: readers that queued before a writer get in before
+	it, and writers get the lock one after the other.
+
+	Readers take a single plain mutex and never wait while no writer holds
+	or wants the lock.  Like ReadWriteLock, using the object in a with
+	statement takes the write lock.  The thread holding the write lock may
+	take it again, and may take read locks.
+
+	**Note**
+
+	Read locks are not reentrant: a thread that takes a second read lock
+	while a writer is waiting will deadlock.
+	"""
+	def __init__(self):
+		self._mutex = threading.Lock()
+		self._changed = threading.Condition(self._mutex)
+		self._tickets = 0
+		self._readers = 0
+		self._writer = None
+		self._write_depth = 0
+		self._waiting_readers = set()
+		self._waiting_writers = collections.deque()
+
+	def __enter__(self):
+		self.acquire_write()
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.release_write()
+
+	def acquire_read(self):
+		"""
+		Acquire a read-lock. Blocks while a writer holds or is waiting for the
+		lock.
+		"""
+		with self._mutex:
+			if self._writer is None and not self._waiting_writers:
+				self._readers += 1
+				return
+			if self._writer == thread.get_ident():
+				self._readers += 1
+				return
+			self._tickets += 1
+			ticket = self._tickets
+			self._waiting_readers.add(ticket)
+			while self._writer is not None or (
+					self._waiting_writers and self._waiting_writers[0] < ticket):
+				self._changed.wait()
+			self._waiting_readers.remove(ticket)
+			self._readers += 1
+
+	def release_read(self):
+		"""Release a read-lock."""
+		with self._mutex:
+			self._readers -= 1
+			if not self._readers and self._waiting_writers:
+				self._changed.notify_all()
+
+	def acquire_write(self):
+		"""
+		Acquire a write lock. Blocks until there are no acquired read- or
+		write-locks, and every thread that queued earlier has had its turn.
+		"""
+		me = thread.get_ident()
+		with self._mutex:
+			if self._writer == me:
+				self._write_depth += 1
+				return
+			self._tickets += 1
+			ticket = self._tickets
+			self._waiting_writers.append(ticket)
+			while (self._writer is not None or self._readers
+					or self._waiting_writers[0] != ticket
+					or any(t < ticket for t in self._waiting_readers)):
+				self._changed.wait()
+			self._waiting_writers.popleft()
+			self._writer = me
+			self._write_depth = 1
+
+	def release_write(self):
+		"""Release a write-lock."""
+		with self._mutex:
+			self._write_depth -= 1
+			if not self._write_depth:
+				self._writer = None
+				self._changed.notify_all()
+
+class LRUCache(object):
+	"""
+	A thread safe mapping that holds at most max_size entries.  When full, the
+	least recently used entry is discarded.
+
+	:param max_size: maximum number of entries to keep
+	"""
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self._data = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		with self._lock:
+			return len(self._data)
+
+	def __contains__(self, key):
+		with self._lock:
+			return key in self._data
+
+	def get(self, key, default=None):
+		"""
+		Returns the value for key and marks it as the most recently used, or
+		default if key is not cached.
+		"""
+		with self._lock:
+			try:
+				value = self._data.pop(key)
+			except KeyError:
+				return default
+			self._data[key] = value
+			return value
+
+	def put(self, key, value):
+		"""Stores value under key, evicting the least recently used entry."""
+		with self._lock:
+			self._data.pop(key, None)
+			self._data[key] = value
+			while len(self._data) > self.max_size:
+				self._data.popitem(last=False)
+
+	def clear(self):
+		"""Empties the cache."""
+		with self._lock:
+			self._data.clear()
+
+class FrozenDict(dict):
+	"""
+	A dict that raises TypeError on any attempt to change it.  Copies made with
+	copy.copy, copy.deepcopy or dict(frozen) can be changed freely.
+	"""
+	def _read_only(self, *args, **kwargs):
+		raise TypeError("FrozenDict does not support item assignment")
+
+	__setitem__ = __delitem__ = _read_only
+	clear = pop = popitem = setdefault = update = _read_only
+
+	def __reduce__(self):
+		return (dict, (dict(self),))
+
+yaml.representer.SafeRepresenter.add_representer(
+	FrozenDict, yaml.representer.SafeRepresenter.represent_dict)
+
+def freeze(value):
+	"""
+	Returns a read only copy of value, converting every dict inside it into a
+	FrozenDict.  Other values are returned as is.
+	"""
+	if isinstance(value, dict):
+		return FrozenDict((key, freeze(item)) for key, item in value.iteritems())
+	return value
+
+class Future(object):
+	"""
+	The result of an asynchronous pettingzoo call.  A small stand in for
+	concurrent.futures.Future, which python 2 does not have.
+	"""
+	def __init__(self):
+		self._done = threading.Event()
+		self._lock = threading.Lock()
+		self._result = None
+		self._exception = None
+		self._callbacks = []
+
+	def done(self):
+		"""Returns True once a result or exception has been set."""
+		return self._done.is_set()
+
+	def result(self, timeout=None):
+		"""
+		Waits for the call to finish and returns its result, or raises its
+		exception.
+
+		:param timeout: (Optional) seconds to wait before giving up
+		:rtype: the result of the call
+		"""
+		if not self._done.wait(timeout):
+			raise Exception("Future timed out after %s seconds" % timeout)
+		if self._exception is not None:
+			raise self._exception
+		return self._result
+
+	def exception(self, timeout=None):
+		"""
+		Waits for the call to finish and returns its exception, or None if it
+		succeeded.
+
+		:param timeout: (Optional) seconds to wait before giving up
+		"""
+		if not self._done.wait(timeout):
+			raise Exception("Future timed out after %s seconds" % timeout)
+		return self._exception
+
+	def add_done_callback(self, callback):
+		"""
+		Calls callback(future) once the call finishes, on the thread that
+		finishes it, or straight away if it already has.
+		"""
+		with self._lock:
+			if not self._done.is_set():
+				self._callbacks.append(callback)
+				return
+		callback(self)
+
+	def set_result(self, result):
+		"""Finishes the call with result."""
+		self._finish(result, None)
+
+	def set_exception(self, exception):
+		"""Finishes the call with exception."""
+		self._finish(None, exception)
+
+	def _finish(self, result, exception):
+		with self._lock:
+			self._result = result
+			self._exception = exception
+			self._done.set()
+			callbacks = self._callbacks
+			self._callbacks = []
+		for callback in callbacks:
+			try:
+				callback(self)
+			except:
+				get_logger().exception("Future callback %r failed" % (callback,))
+
+class Dispatcher(object):
+	"""
+	Runs callbacks on a pool of daemon threads, so that user callbacks never
+	run on the zookeeper event thread or under the lock of a pettingzoo
+	object.  Callbacks submitted with the same key run one at a time, in the
+	order they were submitted.  Callbacks with different keys run in parallel.
+
+	:param workers: (Default 4) number of worker threads
+	:param name: prefix for the names of the worker threads
+
+	**Note**
+
+	stats() returns queue depth metrics: pending (callbacks waiting to run),
+	max_pending (the most that have been waiting at once), running, submitted,
+	completed and failed.  join() waits for the dispatcher to go idle.
+	"""
+	def __init__(self, workers=4, name="pettingzoo-dispatcher"):
+		self.ready = Queue.Queue()
+		self.lock = threading.Lock()
+		self.idle = threading.Condition(self.lock)
+		self.queues = {}
+		self.pending = 0
+		self.max_pending = 0
+		self.running = 0
+		self.submitted = 0
+		self.completed = 0
+		self.failed = 0
+		self.threads = []
+		for index in range(workers):
+			thread = threading.Thread(
+				target=self._run, name="%s-%s" % (name, index))
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def submit(self, key, function, *args):
+		"""
+		Queues function(*args) to run after every callback already submitted
+		with key.
+
+		:param key: any hashable, usually the pettingzoo object the callback \
+		  belongs to
+		:param function: the callback
+		:rtype: None
+		"""
+		with self.lock:
+			self.submitted += 1
+			self.pending += 1
+			self.max_pending = max(self.max_pending, self.pending)
+			queue = self.queues.get(key)
+			if queue is not None:
+				# A worker already owns key and will get to this callback
+				queue.append((function, args))
+				return
+			self.queues[key] = collections.deque([(function, args)])
+		self.ready.put(key)
+
+	def stats(self):
+		"""
+		Returns the queue depth metrics of the dispatcher.
+
+		:rtype: *dict*
+		"""
+		with self.lock:
+			return {
+				'pending': self.pending,
+				'max_pending': self.max_pending,
+				'running': self.running,
+				'submitted': self.submitted,
+				'completed': self.completed,
+				'failed': self.failed}
+
+	def join(self, timeout=None):
+		"""
+		Waits until no callback is waiting or running, for instance to let
+		the callbacks of a change run before checking their effects.
+
+		:param timeout: (Optional) seconds to wait.  Waits forever if None.
+		:rtype: *bool* true if the dispatcher went idle, false on timeout
+
+		**Note**
+
+		Callbacks can be submitted again right after join returns.  Like
+		get_many, this must not be called from a callback, which would wait
+		for itself.
+		"""
+		deadline = None
+		if timeout != None:
+			deadline = time.time() + timeout
+		with self.lock:
+			while self.pending or self.running:
+				if deadline == None:
+					self.idle.wait()
+					continue
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					return False
+				self.idle.wait(remaining)
+			return True
+
+	def _run(self):
+		while True:
+			key = self.ready.get()
+			with self.lock:
+				function, args = self.queues[key].popleft()
+				self.pending -= 1
+				self.running += 1
+			failed = False
+			try:
+				function(*args)
+			except:
+				failed = True
+				get_logger().exception("Dispatcher %r failed" % (function,))
+			with self.lock:
+				self.running -= 1
+				self.completed += 1
+				if failed:
+					self.failed += 1
+				if self.queues[key]:
+					requeue = True
+				else:
+					del self.queues[key]
+					requeue = False
+				if not self.pending and not self.running:
+					self.idle.notify_all()
+			if requeue:
+				# Go to the back of the line so busy keys can not starve others
+				self.ready.put(key)
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+def get_dispatcher():
+	"""
+	Returns the Dispatcher shared by every DistributedBag, LeaderQueue and
+	DistributedDiscovery that is not given one of its own, creating it with
+	default settings on first use.
+
+	:rtype: Dispatcher
+	"""
+	global _dispatcher
+	with _dispatcher_lock:
+		if _dispatcher is None:
+			_dispatcher = Dispatcher()
+		return _dispatcher
+
+def set_dispatcher(dispatcher):
+	"""
+	Replaces the shared Dispatcher, for example with one that has more
+	workers.  Objects created earlier keep the dispatcher they were given.
+
+	:param dispatcher: a Dispatcher
+	:rtype: None
+	"""
+	global _dispatcher
+	with _dispatcher_lock:
+		_dispatcher = dispatcher